@@ -0,0 +1,236 @@
+import os
+import json
+import numpy as np
+import tensorflow as tf
+from viterbi import TRANSITION_PENALTY
+
+
+def get_bucket_boundaries(sequence_lengths, n_buckets=10):
+    """
+    Sentence length boundaries splitting the corpus into n_buckets buckets of similar size.
+    """
+    quantiles = np.percentile(sequence_lengths, np.linspace(0, 100, n_buckets + 1)[1:-1])
+    return sorted(set(int(q) + 1 for q in quantiles))
+
+def make_train_dataset(tokens, labels, offsets, sequence_lengths, char_index_matrix, idx_of_word_pad, idx_of_label_pad, \
+                        batch_size, num_epochs, shuffle=True, bucket_boundaries=None, num_parallel_calls=4, prefetch_batches=8):
+    """
+    tf.data pipeline over a packed corpus (see pack_sequences), yielding batches in the format
+    of batch_iter: (sentences, labels, characters, lengths) padded with idx_of_word_pad,
+    idx_of_label_pad and 0. The batches themselves differ from batch_iter's: the shuffles are
+    drawn separately and bucket_by_sequence_length groups sentences differently from
+    get_epoch_batches.
+    Sentences are shuffled with numpy at each epoch, the char indices are gathered from
+    char_index_matrix by a parallel map and, with bucket_boundaries, sentences are batched
+    with others of similar length.
+    Batches never span two epochs. Without bucket_boundaries an epoch has ceil(n/batch_size)
+    batches like batch_iter; with them it has up to one partial batch per bucket more, so
+    counting epochs as steps // ceil(n/batch_size) drifts by a few steps per epoch.
+    """
+    n_samples = sequence_lengths.shape[0]
+    max_word_len = char_index_matrix.max_word_len
+
+    # one epoch per call, repeat() below calls it again for every epoch
+    def sentences():
+        order = np.random.permutation(n_samples) if shuffle else np.arange(n_samples)
+        for idx in order:
+            yield tokens[offsets[idx]:offsets[idx + 1]], labels[offsets[idx]:offsets[idx + 1]]
+
+    char_matrix = tf.constant(char_index_matrix.matrix, dtype=tf.int32, name='char_index_matrix')
+
+    def add_chars(sentence, label):
+        return sentence, label, tf.gather(char_matrix, sentence), tf.size(sentence)
+
+    dataset = tf.data.Dataset.from_generator(sentences, (tf.int32, tf.int32), (tf.TensorShape([None]), tf.TensorShape([None])))
+    dataset = dataset.map(add_chars, num_parallel_calls=num_parallel_calls)
+
+    padded_shapes = (tf.TensorShape([None]), tf.TensorShape([None]), tf.TensorShape([None, max_word_len]), tf.TensorShape([]))
+    padding_values = (np.int32(idx_of_word_pad), np.int32(idx_of_label_pad), np.int32(0), np.int32(0))
+    if bucket_boundaries is None:
+        dataset = dataset.padded_batch(batch_size, padded_shapes=padded_shapes, padding_values=padding_values)
+    else:
+        dataset = dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+                                    lambda sentence, label, chars, length: length,
+                                    bucket_boundaries, [batch_size]*(len(bucket_boundaries) + 1),
+                                    padded_shapes=padded_shapes, padding_values=padding_values))
+    # batched before repeating, so the last batches of an epoch are not filled with the next one
+    return dataset.repeat(num_epochs).prefetch(prefetch_batches)
+
+LR_SCHEDULES = ['constant', 'inverse_time', 'step', 'cosine']
+
+def get_learning_rate(global_step, schedule, base_lr, steps_per_epoch, n_epochs, decay_rate=0.05, step_epochs=10, step_gamma=0.5, \
+                        min_lr=0.0, warmup_steps=0):
+    """
+    In-graph learning rate of the step global_step:
+    'constant': base_lr
+    'inverse_time': base_lr/(1 + decay_rate*epoch), as Task1_datahelper.next_lr at every epoch
+    'step': base_lr*step_gamma**(epoch//step_epochs)
+    'cosine': cosine decay from base_lr to min_lr over n_epochs
+    With warmup_steps, the rate grows linearly from base_lr/warmup_steps to the scheduled rate
+    during the first warmup_steps steps.
+    """
+    if schedule == 'constant':
+        learning_rate = tf.constant(base_lr, dtype=tf.float32)
+    elif schedule == 'inverse_time':
+        learning_rate = tf.train.inverse_time_decay(base_lr, global_step, steps_per_epoch, decay_rate, staircase=True)
+    elif schedule == 'step':
+        learning_rate = tf.train.exponential_decay(base_lr, global_step, step_epochs*steps_per_epoch, step_gamma, staircase=True)
+    elif schedule == 'cosine':
+        learning_rate = tf.train.cosine_decay(base_lr, global_step, n_epochs*steps_per_epoch, alpha=min_lr/base_lr)
+    else:
+        raise ValueError("Unknown learning rate schedule %s, expected one of %s" % (schedule, LR_SCHEDULES))
+
+    if warmup_steps > 0:
+        step = tf.cast(global_step, tf.float32)
+        learning_rate = tf.where(step < warmup_steps, learning_rate*(step + 1.0)/warmup_steps, learning_rate)
+    return tf.identity(learning_rate, name='learning_rate')
+
+def clip_gradients(gvs, mode='dense', gradient_limit=5.0, clip_norm=5.0, frozen_rows=None):
+    """
+    Clipped (gradient, variable) pairs of optimizer.compute_gradients.
+    'dense': every gradient clipped by value to [-gradient_limit, gradient_limit], which turns
+    the tf.IndexedSlices of embedding lookups into dense [vocab_size, dims] tensors.
+    'sparse': clipped by global norm, IndexedSlices stay sparse so updating an embedding only
+    costs the tokens of the batch. frozen_rows maps variables to a bool [n_rows] array, the
+    gradient of these rows is zeroed.
+    """
+    if mode == 'dense':
+        return [(tf.clip_by_value(grad, -gradient_limit, gradient_limit), var) for grad, var in gvs]
+    elif mode != 'sparse':
+        raise ValueError("Unknown gradient mode %s, expected 'dense' or 'sparse'" % mode)
+
+    frozen_rows = frozen_rows or dict()
+    grads = []
+    variables = []
+    for grad, var in gvs:
+        if grad is None:
+            continue
+        if var in frozen_rows:
+            trainable = tf.constant(~frozen_rows[var], dtype=tf.float32)
+            if isinstance(grad, tf.IndexedSlices):
+                grad = tf.IndexedSlices(grad.values*tf.expand_dims(tf.gather(trainable, grad.indices), -1), grad.indices, grad.dense_shape)
+            else:
+                grad = grad*tf.expand_dims(trainable, -1)
+        grads.append(grad)
+        variables.append(var)
+    grads, _ = tf.clip_by_global_norm(grads, clip_norm)
+    return list(zip(grads, variables))
+
+def sum_tower_gradients(tower_gvs, scale=1.0):
+    """
+    Adds up the compute_gradients lists of the towers of a data-parallel model (same variables
+    in the same order) and multiplies the sums by scale.
+    The tf.IndexedSlices of embedding lookups are concatenated, so they stay sparse.
+    """
+    gvs = []
+    for grads_and_vars in zip(*tower_gvs):
+        var = grads_and_vars[0][1]
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        if len(grads) == 0:
+            gvs.append((None, var))
+        elif all(isinstance(grad, tf.IndexedSlices) for grad in grads):
+            values = tf.concat([grad.values for grad in grads], axis=0)*scale
+            indices = tf.concat([grad.indices for grad in grads], axis=0)
+            gvs.append((tf.IndexedSlices(values, indices, grads[0].dense_shape), var))
+        else:
+            gvs.append((tf.add_n([tf.convert_to_tensor(grad) for grad in grads])*scale, var))
+    return gvs
+
+def constrain_crf_scores(logits, trans_params, sequence_lengths, constraints):
+    """
+    In-graph version of viterbi.constrain_scores: adds TRANSITION_PENALTY to the illegal
+    transitions of trans_params and to the logits of the tags illegal at the first and the
+    last position of every sentence, so crf_decode only returns legal sequences.
+    """
+    allowed, allowed_start, allowed_end = constraints
+    trans_params = trans_params + tf.constant(np.where(allowed, 0.0, TRANSITION_PENALTY), dtype=tf.float32)
+    max_seq_len = tf.shape(logits)[1]
+    first = tf.one_hot(tf.zeros_like(sequence_lengths), max_seq_len, dtype=tf.float32)
+    last = tf.one_hot(sequence_lengths - 1, max_seq_len, dtype=tf.float32)
+    logits = logits + first[:, :, None]*tf.constant(np.where(allowed_start, 0.0, TRANSITION_PENALTY), dtype=tf.float32) \
+                    + last[:, :, None]*tf.constant(np.where(allowed_end, 0.0, TRANSITION_PENALTY), dtype=tf.float32)
+    return logits, trans_params
+
+def export_inference_graph(sess, export_dir, inputs, outputs):
+    """
+    Writes the inference-only part of the graph of sess to export_dir: inference.pb, the graph
+    between the `inputs` and `outputs` tensors (dicts name -> tensor) with the variables frozen
+    into constants, and signature.json with the tensor names of the inputs and outputs.
+    Everything only needed for training (optimizer, loss, input pipeline, the nodes computing
+    the inputs) is left out.
+    """
+    from tensorflow.python.tools import strip_unused_lib
+
+    output_node_names = [tensor.op.name for tensor in outputs.values()]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_node_names)
+    graph_def = strip_unused_lib.strip_unused(graph_def, [tensor.op.name for tensor in inputs.values()], output_node_names, \
+                                                [tensor.dtype.as_datatype_enum for tensor in inputs.values()])
+
+    if not tf.gfile.IsDirectory(export_dir):
+        tf.gfile.MakeDirs(export_dir)
+    with tf.gfile.GFile(os.path.join(export_dir, 'inference.pb'), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    signature = {
+        'inputs': {name: tensor.name for name, tensor in inputs.items()},
+        'outputs': {name: tensor.name for name, tensor in outputs.items()}
+    }
+    with open(os.path.join(export_dir, 'signature.json'), 'w') as f:
+        json.dump(signature, f, indent=4)
+
+def load_inference_graph(export_dir):
+    """
+    Loads a graph written by export_inference_graph.
+    Returns the graph and dicts name -> tensor of its inputs and outputs.
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(os.path.join(export_dir, 'inference.pb'), 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    with open(os.path.join(export_dir, 'signature.json')) as f:
+        signature = json.load(f)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    inputs = {name: graph.get_tensor_by_name(tensor_name) for name, tensor_name in signature['inputs'].items()}
+    outputs = {name: graph.get_tensor_by_name(tensor_name) for name, tensor_name in signature['outputs'].items()}
+    return graph, inputs, outputs
+
+def load_tagging_model(model_folder, config=None):
+    """
+    Opens a session on the model trained in model_folder, using the frozen graph of
+    model_folder/inference when it exists and the latest checkpoint otherwise.
+    Returns the session and dicts name -> tensor of the inputs and the outputs, the outputs of
+    the frozen graph also hold the logits and trans_params (see viterbi.py), the checkpoint
+    only viterbi_sequence.
+    """
+    inference_folder = os.path.join(model_folder, 'inference')
+    if os.path.isfile(os.path.join(inference_folder, 'inference.pb')):
+        graph, inputs, outputs = load_inference_graph(inference_folder)
+        return tf.Session(graph=graph, config=config), inputs, outputs
+
+    graph = tf.Graph()
+    with graph.as_default():
+        sess = tf.Session(graph=graph, config=config)
+        saver = tf.train.import_meta_graph(os.path.join(model_folder, 'ckpt.meta'))
+        with tf.device("/device:gpu:0"):
+            print(tf.train.latest_checkpoint(model_folder))
+            saver.restore(sess, tf.train.latest_checkpoint(model_folder))
+    inputs = {
+        'characters': graph.get_tensor_by_name("characters:0"),
+        'labels': graph.get_tensor_by_name('labels:0'),
+        'lengths': graph.get_tensor_by_name('lengths:0'),
+        'dropout': graph.get_tensor_by_name('dropout:0'),
+        'max_sentences_length_in_batch': graph.get_tensor_by_name('max_sentences_length_in_batch:0'),
+        'vectors': graph.get_tensor_by_name('word-embedding/vectors:0')
+    }
+    return sess, inputs, {'viterbi_sequence': graph.get_tensor_by_name("crf_decode/cond/Merge:0")}
+
+# feed dict keys of get_batched_feed_dict_for_testing for the input names of load_tagging_model
+TESTING_FEED_KEYS = {
+    'characters': 'chars_placeholder',
+    'labels': 'labels_placeholder',
+    'lengths': 'sequence_lengths_placeholder',
+    'dropout': 'dropout_prob_placeholder',
+    'max_sentences_length_in_batch': 'max_sentences_length_placeholder',
+    'vectors': 'vectors'
+}
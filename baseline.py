@@ -3,7 +3,7 @@ import shelve
 import numpy as np
 import tensorflow as tf
 from time import time
-from Task1_datahelper import load_from_file, word_2_indices_per_char, decode_labels, batch_iter, get_word_from_idx
+from Task1_datahelper import load_data_feed, word_2_indices_per_char, decode_labels, batch_iter, get_word_from_idx, predict_in_batches, write_predictions, get_max_doc_len
 import sys
 from math import sqrt
 
@@ -11,9 +11,8 @@ type_embeddings = sys.argv[1].strip()
 tagging = sys.argv[2].strip()
 print(type_embeddings)
 print(tagging)
-data = load_from_file("../data_feed_model/%s_%s.shlv" % (type_embeddings, tagging))
+data = load_data_feed("../data_feed_model/%s_%s" % (type_embeddings, tagging), unpack=True)
 
-max_doc_len = data['max_doc_len']
 max_word_len = data['max_word_len']
 labels_template = data['labels_template']
 
@@ -25,6 +24,9 @@ dev_sents = data["dev_sentences"]
 dev_labels = data["dev_labels"]
 dev_sequence_lengths = data["dev_sequence_lengths"]
 
+# the data feed has no max_doc_len, every batch is padded to the longest sentence of both splits
+max_doc_len = max(get_max_doc_len(train_sequence_lengths), get_max_doc_len(dev_sequence_lengths))
+
 word_lookup_table = data['lookup_table']
 map_word_id = data['map_word_id']
 map_id_word = data['map_id_word']
@@ -34,6 +36,7 @@ hidden_size_lstm = 200
 dropout_prob = 0.5
 n_epochs = 50
 batch_size = 10
+eval_batch_size = 64
 n_batches = int(train_sentences.shape[0]//batch_size) + 1
 learning_rate = 0.015
 momentum = 0.9
@@ -92,10 +95,10 @@ with tf.Session(config = config) as sess:
     print("Training: Start")
 
     step = 0
-    batches = batch_iter(train_sentences, train_labels, train_sequence_lengths, batch_size=batch_size, num_epochs=n_epochs, shuffle=True)
+    batches = batch_iter(train_sentences, train_labels, train_sequence_lengths, map_word_id[''], labels_template.index('PAD'), batch_size=batch_size, num_epochs=n_epochs, shuffle=True, pad_to_length=max_doc_len)
     timer = time()
     for batch in batches: 
-        sent_batch, label_batch, sequence_length_batch = batch
+        sent_batch, label_batch, sequence_length_batch, _ = batch
 
         loss_,_, predicts= sess.run([loss, train_op, viterbi_sequence], feed_dict={
                                                                                 sentences_placeholder: sent_batch, 
@@ -117,28 +120,21 @@ with tf.Session(config = config) as sess:
     print("\n\n\n")
     
     print('Developing: Start')
-    if os.path.isdir('eval_dev'):
-        os.mkdir('eval_dev')
+    if not os.path.isdir('../eval_dev'):
+        os.mkdir('../eval_dev')
+
+    def get_dev_feed_dict(sent_batch, label_batch, sequence_length_batch, max_sentences_length_in_batch):
+        return {sentences_placeholder: sent_batch,
+                labels_placeholder: label_batch,
+                sequence_lengths_placeholder: sequence_length_batch,
+                dropout_prob_placeholder: 1.0
+                }
+
     tsvfile = open('../eval_dev/baseline_predict_file_%s_%s.tsv' % (type_embeddings, tagging), 'w')
-    for idx in range(dev_sents.shape[0]):
-        sent = dev_sents[idx].reshape(1, -1)
-        label = dev_labels[idx].reshape(1, -1)
-        sequence_length = np.array([dev_sequence_lengths[idx]])
-
-        predict = sess.run(viterbi_sequence, feed_dict={sentences_placeholder: sent,
-                                                        labels_placeholder: label,
-                                                        sequence_lengths_placeholder: sequence_length,
-                                                        dropout_prob_placeholder: 1.0
-                                                        })
-
-        sent = sent[0]
-        label = label[0]
-        if sequence_length[0] > 0:
-            for subidx in range(sequence_length[0]):        
-                word = get_word_from_idx(map_id_word, sent[subidx])
-                golden_tag = labels_template[label[subidx]]
-                predict_tag = labels_template[predict[0][subidx]]
-                tsvfile.write("%s\t%s\t%s\n" % (word, golden_tag, predict_tag))
-            tsvfile.write('-\tX\t-\n')
-        
+    dev_batches = predict_in_batches(sess, viterbi_sequence, get_dev_feed_dict, dev_sents, dev_labels, dev_sequence_lengths, \
+                                    map_word_id[''], labels_template.index('PAD'), batch_size=eval_batch_size, pad_to_length=max_doc_len)
+    for sent_batch, label_batch, sequence_length_batch, predicts in dev_batches:
+        write_predictions(tsvfile, sent_batch, label_batch, sequence_length_batch, predicts, map_id_word, labels_template)
+    tsvfile.close()
+
     print("Developing: Done")
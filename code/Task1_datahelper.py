@@ -1,5 +1,9 @@
 import os
 import csv
+import json
+import zlib
+import queue
+import threading
 import numpy as np
 import shelve
 
@@ -9,35 +13,70 @@ from time import time
 from math import sqrt
 
 LIMIT_LENGTH_OF_SENTENCES = 300
+UNKNOWN_WORD = '<unk>'
+LOOKUP_TABLE_SEED = 1234 # random vectors of the OOV words, fixed so preprocess builds the same table every run
 
-def readFileTSV(dirname='../train_tsv'):
+def iter_sentences_tsv(filename):
+    """
+    Lazily yields (sentence, label, length) from one 3-column TSV file.
+    Sentences are separated by lines with a single column, sentences longer
+    than LIMIT_LENGTH_OF_SENTENCES are skipped.
+    """
+    sent = []
+    label = []
+    with open(filename) as f:
+        for line in f:
+            row = line.strip().split("\t")
+            if len(row) == 1:
+                if 0 < len(sent) <= LIMIT_LENGTH_OF_SENTENCES:
+                    yield sent, label, len(sent)
+                label = []
+                sent = []
+            elif len(row) == 3:
+                sent.append(row[0].lower().strip())
+                label.append(row[1])
+    # last sentence of a file without a trailing separator line
+    if 0 < len(sent) <= LIMIT_LENGTH_OF_SENTENCES:
+        yield sent, label, len(sent)
+
+def _read_sentences_tsv(filename):
+    return list(iter_sentences_tsv(filename))
+
+def iter_corpus_tsv(dirname='../train_tsv', n_workers=1):
+    """
+    Lazily yields (sentence, label, length) for every file of a directory.
+    With n_workers > 1 the files are parsed in parallel by a process pool,
+    the order of the sentences is the same as with n_workers=1.
+    """
+    filenames = [os.path.join(dirname, filename) for filename in os.listdir(dirname)]
+    if n_workers <= 1 or len(filenames) <= 1:
+        for filename in filenames:
+            yield from iter_sentences_tsv(filename)
+        return
+
+    from multiprocessing import Pool
+    with Pool(processes=min(n_workers, len(filenames))) as pool:
+        for sentences_of_file in pool.imap(_read_sentences_tsv, filenames):
+            yield from sentences_of_file
+
+def _to_object_array(items):
+    # np.array() on equal-length lists would build a 2D array
+    res = np.empty(len(items), dtype=object)
+    for idx, item in enumerate(items):
+        res[idx] = item
+    return res
+
+def readFileTSV(dirname='../train_tsv', n_workers=1):
     sentences = []
     labels = []
     sequence_lengths = []
-    sent = []
-    label = []
-    leng = 0
-
-    for filename in os.listdir(dirname):
-        with open(os.path.join(dirname, filename)) as f:
-            for _, line in enumerate(f.readlines()):
-                row = line.strip()
-                row = re.split("\t", row)
-                if len(row) == 1:
-                    if leng > 0 and leng <= LIMIT_LENGTH_OF_SENTENCES:
-                        sentences.append(sent)
-                        labels.append(label)
-                        sequence_lengths.append(leng)
-                    leng = 0
-                    label = []
-                    sent = []
-                    
-                elif len(row) == 3:
-                    sent.append(row[0].lower().strip())
-                    label.append(row[1])
-                    leng += 1
-
-    return np.array(sentences), np.array(labels), np.array(sequence_lengths)
+
+    for sent, label, leng in iter_corpus_tsv(dirname, n_workers=n_workers):
+        sentences.append(sent)
+        labels.append(label)
+        sequence_lengths.append(leng)
+
+    return _to_object_array(sentences), _to_object_array(labels), np.array(sequence_lengths, dtype=np.int64)
 
 def get_idx_train_dev(sentences, train_ratio):
     n_samples = sentences.shape[0]
@@ -48,13 +87,38 @@ def get_idx_train_dev(sentences, train_ratio):
     test_idx = np.array(list(set(range(n_samples)) - set(train_idx)))
     return train_idx, test_idx
 
-def get_vocabs(sentences):
-    vocabs = []
-    for sent in sentences:
-        for word in sent:
-            if word not in vocabs:
-                vocabs.append(word)
+def _count_in_order(sequences):
+    # dict keeps the first-occurrence order of the keys
+    counts = dict()
+    for seq in sequences:
+        for item in seq:
+            counts[item] = counts.get(item, 0) + 1
+    return counts
+
+def _cut_off(counts, min_freq=1, max_size=None):
+    kept = [item for item in counts if counts[item] >= min_freq]
+    if max_size is not None and len(kept) > max_size:
+        # the most frequent items win, the stable sort gives ties to the first seen
+        most_frequent = set(sorted(kept, key=lambda item: -counts[item])[:max_size])
+        kept = [item for item in kept if item in most_frequent]
+    return kept
+
+def get_vocabs_with_counts(sentences, min_freq=1, max_vocabs=None):
+    """
+    Single pass vocabulary builder.
+    Returns the vocabs in first-occurrence order (as get_vocabs) and a dict word -> frequency.
+    Words seen less than min_freq times or beyond the max_vocabs most frequent ones
+    are dropped and replaced by UNKNOWN_WORD, which encode_sentences falls back to.
+    """
+    counts = _count_in_order(sentences)
+    vocabs = _cut_off(counts, min_freq=min_freq, max_size=max_vocabs)
+    if len(vocabs) < len(counts):
+        vocabs.append(UNKNOWN_WORD)
     vocabs.append('')
+    return vocabs, counts
+
+def get_vocabs(sentences, min_freq=1, max_vocabs=None):
+    vocabs, _ = get_vocabs_with_counts(sentences, min_freq=min_freq, max_vocabs=max_vocabs)
     return vocabs
 
 def get_map_word_id_and_map_id_word(vocabs):
@@ -86,7 +150,13 @@ def word_2_indices_per_char(word, max_word_len, char_dict):
             data[i + rest//2] = 0
     return data
 
-def generate_lookup_word_embedding(vocabs, map_word_id, type_embeddings='word2vec'):
+EMBEDDINGS_CACHE_DIR = '../embeddings/cache'
+_embedding_stores = dict()
+
+def load_gensim_word2vec(type_embeddings):
+    """
+    Parses the original embedding file of type_embeddings with gensim (slow).
+    """
     pretrained_word2vec = None
     if type_embeddings == 'bio-word2vec':
         from gensim.models.keyedvectors import KeyedVectors
@@ -114,34 +184,226 @@ def generate_lookup_word_embedding(vocabs, map_word_id, type_embeddings='word2ve
         tmp_file = get_tmpfile("glove_to_word2vec.txt")
         glove2word2vec(filename, tmp_file)
         pretrained_word2vec = KeyedVectors.load_word2vec_format(tmp_file, binary=False)
-    elif type_embeddings == 'random':
-        pretrained_word2vec = dict()
-        dims = 300
-        pretrained_word2vec[''] = np.random.uniform(-sqrt(3.0/dims), sqrt(3.0/dims), dims)
-    #print(type_embeddings, end=' ')
     assert pretrained_word2vec is not None
-    if type_embeddings != 'random':
-        dims = len(pretrained_word2vec[[*pretrained_word2vec.vocab.keys()][0]])
-    else: 
-        dims = 300
-    n_vocabs = len(vocabs)
-
-    OOV = []
-    lookup_table = np.zeros(shape=[n_vocabs, dims])
-    c = 0
-    for _, word in enumerate(vocabs):
-        idx = map_word_id[word]
-
-        if word in pretrained_word2vec:
-            lookup_table[idx, :] = pretrained_word2vec[word]
-        else:
-            c += 1
-            lookup_table[idx, :] = np.random.uniform(-sqrt(3.0/dims), sqrt(3.0/dims), dims)
-            OOV.append(word)
+    return pretrained_word2vec
+
+class EmbeddingStore(object):
+    """
+    Pretrained embeddings as a float32 [n_words, dims] matrix (usually memory-mapped)
+    and a word -> row index. Supports `word in store` and `store[word]` like KeyedVectors.
+    """
+    def __init__(self, vectors, words):
+        self.vectors = vectors
+        self.words = words
+        self.index = {word: idx for idx, word in enumerate(words)}
+
+    @property
+    def dims(self):
+        return self.vectors.shape[1]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __getitem__(self, word):
+        return self.vectors[self.index[word]]
+
+def get_embedding_cache_filenames(type_embeddings, cache_dir=EMBEDDINGS_CACHE_DIR):
+    return os.path.join(cache_dir, '%s.npy' % type_embeddings), os.path.join(cache_dir, '%s.vocab.txt' % type_embeddings)
+
+def build_embedding_cache(type_embeddings, cache_dir=EMBEDDINGS_CACHE_DIR):
+    """
+    Converts the embedding file of type_embeddings once into <type>.npy (float32 vectors)
+    and <type>.vocab.txt (one word per line, in row order).
+    """
+    pretrained_word2vec = load_gensim_word2vec(type_embeddings)
+    if hasattr(pretrained_word2vec, 'index_to_key'):
+        words = pretrained_word2vec.index_to_key
+    else:
+        words = pretrained_word2vec.index2word
+    vectors = np.asarray(pretrained_word2vec.vectors, dtype=np.float32)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    vectors_filename, vocab_filename = get_embedding_cache_filenames(type_embeddings, cache_dir)
+    # write to temporary files first so concurrent readers never see partial files
+    with open(vectors_filename + '.tmp', 'wb') as f:
+        np.save(f, vectors)
+    with open(vocab_filename + '.tmp', 'w', encoding='utf-8') as f:
+        for word in words:
+            f.write("%s\n" % word)
+    os.replace(vocab_filename + '.tmp', vocab_filename)
+    os.replace(vectors_filename + '.tmp', vectors_filename)
+
+def load_pretrained_embeddings(type_embeddings, cache_dir=EMBEDDINGS_CACHE_DIR):
+    """
+    Returns the EmbeddingStore of type_embeddings, building the cache on first use.
+    The vectors are memory-mapped read-only, so processes loading the same store share pages.
+    """
+    if type_embeddings in _embedding_stores:
+        return _embedding_stores[type_embeddings]
 
-    for k in OOV_dict:
-        print("%s\t%d" % (k, OOV_dict[k]))
-    # print(c)
+    vectors_filename, vocab_filename = get_embedding_cache_filenames(type_embeddings, cache_dir)
+    if not (os.path.isfile(vectors_filename) and os.path.isfile(vocab_filename)):
+        build_embedding_cache(type_embeddings, cache_dir)
+
+    vectors = np.load(vectors_filename, mmap_mode='r')
+    with open(vocab_filename, encoding='utf-8') as f:
+        words = [line.rstrip('\n') for line in f]
+    assert len(words) == vectors.shape[0]
+
+    _embedding_stores[type_embeddings] = EmbeddingStore(vectors, words)
+    return _embedding_stores[type_embeddings]
+
+def word_ngram_buckets(word, n_buckets, minn=3, maxn=6):
+    """
+    Hash buckets of the character n-grams (minn <= n <= maxn) of '<' + word + '>'.
+    """
+    word = '<' + word + '>'
+    ngrams = [word[start:start + n] for n in range(minn, maxn + 1) for start in range(len(word) - n + 1)]
+    return [zlib.crc32(ngram.encode('utf-8')) % n_buckets for ngram in ngrams]
+
+class NgramVectors(object):
+    """
+    Hashed char-n-gram table, row b is the mean vector of the pretrained words having an
+    n-gram in bucket b. The vector of a word is the mean of the rows of its non-empty buckets.
+    """
+    def __init__(self, vectors, counts, minn, maxn):
+        self.vectors = vectors
+        self.counts = counts
+        self.minn = minn
+        self.maxn = maxn
+
+    @property
+    def dims(self):
+        return self.vectors.shape[1]
+
+    def compose(self, words):
+        """
+        Returns float32 [len(words), dims] vectors and a boolean array marking the words
+        without any known n-gram (their rows are zeros).
+        """
+        owners = []
+        buckets = []
+        for idx, word in enumerate(words):
+            word_buckets = word_ngram_buckets(word, self.counts.shape[0], self.minn, self.maxn)
+            buckets.extend(word_buckets)
+            owners.extend([idx]*len(word_buckets))
+        owners = np.array(owners, dtype=np.int64)
+        buckets = np.array(buckets, dtype=np.int64)
+        known = self.counts[buckets] > 0
+        owners, buckets = owners[known], buckets[known]
+
+        vectors = np.zeros(shape=[len(words), self.dims], dtype=np.float32)
+        np.add.at(vectors, owners, self.vectors[buckets])
+        n_ngrams = np.bincount(owners, minlength=len(words))
+        vectors[n_ngrams > 0] /= n_ngrams[n_ngrams > 0, np.newaxis]
+        return vectors, n_ngrams == 0
+
+def get_ngram_cache_filenames(type_embeddings, cache_dir=EMBEDDINGS_CACHE_DIR):
+    prefix = os.path.join(cache_dir, '%s.ngrams' % type_embeddings)
+    return prefix + '.npy', prefix + '.counts.npy', prefix + '.json'
+
+def build_ngram_cache(type_embeddings, cache_dir=EMBEDDINGS_CACHE_DIR, n_buckets=2**20, minn=3, maxn=6, chunk_size=5000):
+    """
+    Builds the NgramVectors table of type_embeddings offline from its EmbeddingStore,
+    chunk_size words at a time, into <type>.ngrams.npy, <type>.ngrams.counts.npy and <type>.ngrams.json.
+    """
+    pretrained_word2vec = load_pretrained_embeddings(type_embeddings, cache_dir)
+    vectors_filename, counts_filename, params_filename = get_ngram_cache_filenames(type_embeddings, cache_dir)
+
+    sums = np.lib.format.open_memmap(vectors_filename + '.tmp', mode='w+', dtype=np.float32, shape=(n_buckets, pretrained_word2vec.dims))
+    counts = np.zeros(shape=[n_buckets], dtype=np.int64)
+    for chunk_start in range(0, len(pretrained_word2vec), chunk_size):
+        rows = []
+        buckets = []
+        for row in range(chunk_start, min(chunk_start + chunk_size, len(pretrained_word2vec))):
+            word_buckets = word_ngram_buckets(pretrained_word2vec.words[row], n_buckets, minn, maxn)
+            buckets.extend(word_buckets)
+            rows.extend([row]*len(word_buckets))
+        order = np.argsort(buckets, kind='stable')
+        buckets = np.array(buckets, dtype=np.int64)[order]
+        rows = np.array(rows, dtype=np.int64)[order]
+        if buckets.shape[0] == 0:
+            continue
+        unique_buckets, starts = np.unique(buckets, return_index=True)
+        sums[unique_buckets] += np.add.reduceat(pretrained_word2vec.vectors[rows], starts, axis=0)
+        counts += np.bincount(buckets, minlength=n_buckets)
+
+    for chunk_start in range(0, n_buckets, chunk_size):
+        chunk_counts = np.maximum(counts[chunk_start:chunk_start + chunk_size], 1)
+        sums[chunk_start:chunk_start + chunk_size] /= chunk_counts[:, np.newaxis]
+    sums.flush()
+    del sums
+
+    np.save(counts_filename, counts)
+    with open(params_filename, 'w') as f:
+        json.dump({'n_buckets': n_buckets, 'minn': minn, 'maxn': maxn}, f)
+    os.replace(vectors_filename + '.tmp', vectors_filename)
+
+def load_ngram_vectors(type_embeddings, cache_dir=EMBEDDINGS_CACHE_DIR):
+    """
+    Returns the memory-mapped NgramVectors of type_embeddings, building them on first use.
+    """
+    if ('ngrams', type_embeddings) in _embedding_stores:
+        return _embedding_stores[('ngrams', type_embeddings)]
+
+    vectors_filename, counts_filename, params_filename = get_ngram_cache_filenames(type_embeddings, cache_dir)
+    if not os.path.isfile(vectors_filename):
+        build_ngram_cache(type_embeddings, cache_dir)
+    with open(params_filename) as f:
+        params = json.load(f)
+    ngram_vectors = NgramVectors(np.load(vectors_filename, mmap_mode='r'), np.load(counts_filename), params['minn'], params['maxn'])
+
+    _embedding_stores[('ngrams', type_embeddings)] = ngram_vectors
+    return ngram_vectors
+
+def lookup_word_vectors(words, type_embeddings, seed=None, dims=300, oov_backend='random'):
+    """
+    float32 [len(words), dims] vectors of words from the cached embeddings of type_embeddings.
+    With oov_backend='ngram' words missing from the embeddings are composed from their
+    char-n-grams (see NgramVectors). The remaining ones get uniform(-sqrt(3/dims), sqrt(3/dims))
+    vectors drawn with np.random.RandomState(seed). dims is only used for type_embeddings='random'.
+    Returns the vectors and a boolean array marking the OOV words.
+    """
+    if type_embeddings == 'random':
+        index = dict()
+    else:
+        pretrained_word2vec = load_pretrained_embeddings(type_embeddings)
+        index = pretrained_word2vec.index
+        dims = pretrained_word2vec.dims
+    n_words = len(words)
+
+    pretrained_ids = np.fromiter((index.get(word, -1) for word in words), dtype=np.int64, count=n_words)
+    is_oov = pretrained_ids < 0
+
+    vectors = np.zeros(shape=[n_words, dims], dtype=np.float32)
+    if not is_oov.all():
+        vectors[~is_oov] = pretrained_word2vec.vectors[pretrained_ids[~is_oov]]
+
+    is_random = is_oov.copy()
+    if oov_backend == 'ngram' and type_embeddings != 'random' and is_oov.any():
+        oov_ids = np.flatnonzero(is_oov)
+        vectors[oov_ids], no_ngram = load_ngram_vectors(type_embeddings).compose([words[idx] for idx in oov_ids])
+        is_random[oov_ids] = no_ngram
+
+    rng = np.random.RandomState(seed)
+    vectors[is_random] = rng.uniform(-sqrt(3.0/dims), sqrt(3.0/dims), size=[int(is_random.sum()), dims])
+    return vectors, is_oov
+
+def generate_lookup_word_embedding(vocabs, map_word_id, type_embeddings='word2vec', seed=None, oov_backend='random'):
+    """
+    float32 [len(vocabs), dims] table, row map_word_id[word] holds the vector of word
+    from lookup_word_vectors. The sorted OOV words are written to oov_dict.txt.
+    """
+    vectors, is_oov = lookup_word_vectors(vocabs, type_embeddings, seed=seed, oov_backend=oov_backend)
+    rows = np.fromiter((map_word_id[word] for word in vocabs), dtype=np.int64, count=len(vocabs))
+    lookup_table = np.zeros(shape=vectors.shape, dtype=np.float32)
+    lookup_table[rows] = vectors
+
+    OOV = [vocabs[idx] for idx in np.flatnonzero(is_oov)]
     OOV.sort()
     with open('oov_dict.txt', 'w') as f:
         for line in OOV:
@@ -153,7 +415,10 @@ def encode_sentences(sentences, map_word_id):
     for idx, sent in enumerate(sentences):
         tmp = np.zeros(shape=[len(sent)], dtype=np.int32)
         for subidx, word in enumerate(sent):
-            idx_of_word = map_word_id[word]
+            if word in map_word_id:
+                idx_of_word = map_word_id[word]
+            else:
+                idx_of_word = map_word_id[UNKNOWN_WORD]
             tmp[subidx] = idx_of_word
         encoded_sentences[idx] = tmp
     return encoded_sentences
@@ -172,21 +437,26 @@ def train_dev_split(sentences, labels, sequence_lengths, train_idx, test_idx, ty
         "dev_sequence_lengths": dev_sequence_lengths
     }
 
-def get_labels_template(labels):
-    labels_template = []
-    for label in labels:
-        for sublabel in label:
-            if sublabel not in labels_template:
-                labels_template.append(sublabel)
+def get_labels_template_with_counts(labels):
+    """
+    Single pass label template builder, returns the template and a dict label -> frequency.
+    """
+    counts = _count_in_order(labels)
+    labels_template = list(counts)
     labels_template.append('PAD')
+    return labels_template, counts
+
+def get_labels_template(labels):
+    labels_template, _ = get_labels_template_with_counts(labels)
     return labels_template
 
 def encode_labels(labels, labels_template):
+    map_label_id = {label: idx for idx, label in enumerate(labels_template)}
     labels_encoded = np.zeros(shape=[labels.shape[0]], dtype=object)
     for idx, label in enumerate(labels):
         tmp = np.zeros(shape=[len(label)], dtype=np.int32)
         for subidx, sublabel in enumerate(label):
-            tmp[subidx] = labels_template.index(sublabel)
+            tmp[subidx] = map_label_id[sublabel]
         labels_encoded[idx] = tmp
     return labels_encoded
 
@@ -199,6 +469,13 @@ def decode_labels(encoded_labels, labels_template):
         labels_decoded.append(label_decoded)
     return np.array(labels_decoded)
 
+def get_rare_rows(tokens, vocab_size, min_count):
+    """
+    Boolean [vocab_size] array, True for the word ids seen less than min_count times in
+    tokens (e.g. a packed training buffer).
+    """
+    return np.bincount(np.asarray(tokens, dtype=np.int64), minlength=vocab_size)[:vocab_size] < min_count
+
 def get_max_doc_len(sequence_lengths):
     max_doc_len = 0
     for leng in sequence_lengths:
@@ -207,50 +484,307 @@ def get_max_doc_len(sequence_lengths):
 
     
     
-def batch_iter(sentences, labels, sequence_lengths, idx_of_word_pad, idx_of_label_pad, batch_size=32, num_epochs=1000, shuffle=True):
+def pack_sequences(sequences):
+    """
+    Flattens ragged int sequences into one int32 buffer plus int64 offsets,
+    sequence i is buffer[offsets[i]:offsets[i + 1]].
+    """
+    n_sequences = len(sequences)
+    offsets = np.zeros(shape=[n_sequences + 1], dtype=np.int64)
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=n_sequences)
+    np.cumsum(lengths, out=offsets[1:])
+    buffer = np.zeros(shape=[offsets[-1]], dtype=np.int32)
+    for idx, seq in enumerate(sequences):
+        buffer[offsets[idx]:offsets[idx + 1]] = seq
+    return buffer, offsets
+
+def pad_batch(buffer, offsets, indices, sequence_lengths, pad_value, max_length=None):
+    """
+    Gathers the packed sequences `indices` into a [len(indices), max_length] int32 matrix,
+    positions after the end of a sequence are set to pad_value.
+    """
+    lengths = sequence_lengths[indices]
+    if max_length is None:
+        max_length = lengths.max()
+    positions = np.arange(max_length)
+    mask = positions[np.newaxis, :] < lengths[:, np.newaxis]
+    padded = np.full(shape=[len(indices), max_length], fill_value=pad_value, dtype=np.int32)
+    padded[mask] = buffer[(offsets[indices][:, np.newaxis] + positions[np.newaxis, :])[mask]]
+    return padded
+
+def get_epoch_batches(order, sequence_lengths, batch_size, bucket_size=None, shuffle=True):
+    """
+    Splits `order` into the index arrays of the batches of one epoch.
+    With bucket_size, windows of bucket_size*batch_size sentences are sorted by length
+    before being cut into batches, then the batches are shuffled.
+    """
+    n_samples = order.shape[0]
+    if bucket_size is None:
+        return [order[start:start + batch_size] for start in range(0, n_samples, batch_size)]
+
+    batches = []
+    window_size = bucket_size*batch_size
+    for window_start in range(0, n_samples, window_size):
+        window = order[window_start:window_start + window_size]
+        window = window[np.argsort(sequence_lengths[window], kind='stable')]
+        batches.extend(window[start:start + batch_size] for start in range(0, window.shape[0], batch_size))
+    if shuffle:
+        batches = [batches[idx] for idx in np.random.permutation(len(batches))]
+    return batches
+
+def batch_iter(sentences, labels, sequence_lengths, idx_of_word_pad, idx_of_label_pad, batch_size=32, num_epochs=1000, shuffle=True, offsets=None, bucket_size=None, padding_stats=None, pad_to_length=None, iter_state=None, resume_state=None):
     """
     Generates a batch iterator for a dataset.
+    sentences and labels are either arrays of encoded sequences, or packed buffers
+    (see pack_sequences) sharing `offsets`.
+    bucket_size enables length-bucketed batches (see get_epoch_batches).
+    If padding_stats is a dict, 'real_tokens', 'padded_tokens' and 'padding_ratio'
+    are updated in it for every yielded batch.
+    pad_to_length pads every batch to a fixed length instead of its longest sentence.
+    If iter_state is a dict, the start of every epoch is recorded in it so that
+    get_batch_iter_state can tell the position after any number of consumed batches.
+    resume_state (see get_batch_iter_state) restarts the iteration at that position, with the
+    same batches as the original run.
     """
-    n_samples = sentences.shape[0]
-    num_batches_per_epoch = int((n_samples-1)/batch_size) + 1
-    for epoch in range(num_epochs):
+    if offsets is None:
+        sentences, offsets = pack_sequences(sentences)
+        labels, _ = pack_sequences(labels)
+    sequence_lengths = np.asarray(sequence_lengths)
+    if padding_stats is not None:
+        padding_stats.setdefault('real_tokens', 0)
+        padding_stats.setdefault('padded_tokens', 0)
+
+    n_samples = sequence_lengths.shape[0]
+    order = np.arange(n_samples)
+    first_epoch, skipped_batches, step = 0, 0, 0
+    if resume_state is not None:
+        first_epoch, skipped_batches, step = resume_state['epoch'], resume_state['batch'], resume_state['step']
+        order = np.array(resume_state['order'])
+        np.random.set_state(resume_state['rng_state'])
+    if iter_state is not None:
+        iter_state.setdefault('epoch_starts', [])
+
+    for epoch in range(first_epoch, num_epochs):
+        if iter_state is not None:
+            iter_state['epoch_starts'].append((step - skipped_batches, epoch, order.copy(), np.random.get_state()))
         # Shuffle the data at each epoch
         if shuffle:
-            shuffle_indices = np.random.permutation(np.arange(n_samples))
+            order = order[np.random.permutation(np.arange(n_samples))]
 
-            sentences = sentences[shuffle_indices]
-            labels = labels[shuffle_indices]
-            sequence_lengths = sequence_lengths[shuffle_indices]
-        
-        for batch_num in range(num_batches_per_epoch):
-            start_index = batch_num * batch_size
-            end_index = min((batch_num + 1) * batch_size, n_samples)
+        epoch_batches = get_epoch_batches(order, sequence_lengths, batch_size, bucket_size=bucket_size, shuffle=shuffle)
+        for indices in epoch_batches[skipped_batches:]:
+            if pad_to_length is None:
+                max_sentences_length_in_batch = sequence_lengths[indices].max()
+            else:
+                max_sentences_length_in_batch = pad_to_length
+            padded_sentences = pad_batch(sentences, offsets, indices, sequence_lengths, idx_of_word_pad, max_sentences_length_in_batch)
+            padded_labels = pad_batch(labels, offsets, indices, sequence_lengths, idx_of_label_pad, max_sentences_length_in_batch)
 
-            max_sentences_length_in_batch = max([length for length in sequence_lengths[start_index:end_index]])
+            if padding_stats is not None:
+                padding_stats['real_tokens'] += int(sequence_lengths[indices].sum())
+                padding_stats['padded_tokens'] += int(padded_sentences.size)
+                padding_stats['padding_ratio'] = 1.0 - float(padding_stats['real_tokens'])/padding_stats['padded_tokens']
 
-            actual_batch_size = min(batch_size, end_index - start_index)
-            padded_sentences = np.zeros(shape=[actual_batch_size, max_sentences_length_in_batch], dtype=np.int32)
-            padded_labels = np.zeros(shape=[actual_batch_size, max_sentences_length_in_batch], dtype=np.int32)
+            step += 1
+            yield padded_sentences, padded_labels, sequence_lengths[indices], max_sentences_length_in_batch
+        skipped_batches = 0
 
-            # print(start_index, ' ', end_index, ' ', end_index - start_index)
-            for idx in range(min(batch_size, end_index - start_index)):
-                for subidx in range(max_sentences_length_in_batch):
-                    if subidx < sequence_lengths[start_index + idx]:
-                        padded_sentences[idx][subidx] = sentences[start_index + idx][subidx]
-                        padded_labels[idx][subidx] = labels[start_index + idx][subidx]
-                        
-                    else:
-                        padded_sentences[idx][subidx] = idx_of_word_pad
-                        padded_labels[idx][subidx] = idx_of_label_pad
-                    
+def get_batch_iter_state(iter_state, step):
+    """
+    Position of batch_iter after `step` consumed batches, from the iter_state it filled
+    (the producer may be ahead, e.g. with prefetch): the epoch, the batch in the epoch and
+    the order and numpy RNG state at the start of the epoch.
+    Epochs before the returned one are forgotten, so step must not decrease between calls.
+    """
+    epoch_starts = iter_state['epoch_starts']
+    while len(epoch_starts) > 1 and epoch_starts[1][0] <= step:
+        epoch_starts.pop(0)
+    first_step, epoch, order, rng_state = epoch_starts[0]
+    return {'step': step, 'epoch': epoch, 'batch': step - first_step, 'order': order, 'rng_state': rng_state}
 
-            yield padded_sentences, padded_labels, sequence_lengths[start_index:end_index], max_sentences_length_in_batch
+def save_batch_iter_state(filename, state):
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = state['rng_state']
+    np.savez(filename, step=state['step'], epoch=state['epoch'], batch=state['batch'], order=state['order'], \
+             rng_keys=rng_keys, rng_pos=rng_pos, rng_has_gauss=rng_has_gauss, rng_cached_gaussian=rng_cached_gaussian)
+
+def load_batch_iter_state(filename):
+    with np.load(filename) as f:
+        return {'step': int(f['step']), 'epoch': int(f['epoch']), 'batch': int(f['batch']), 'order': f['order'], \
+                'rng_state': ('MT19937', f['rng_keys'], int(f['rng_pos']), int(f['rng_has_gauss']), float(f['rng_cached_gaussian']))}
 
 
 def get_word_from_idx(map_id_word, idx):
     return map_id_word[idx]
 
-def word_indices_to_char_indices(sents, lengths, max_doc_len, max_word_len, char_dict, map_id_word):
+def predict_in_batches(sess, viterbi_sequence, get_feed_dict, sentences, labels, sequence_lengths, idx_of_word_pad, idx_of_label_pad, batch_size=64, pad_to_length=None, offsets=None):
+    """
+    Decodes a dataset batch by batch, in the original sentence order.
+    get_feed_dict(sent_batch, label_batch, sequence_length_batch, max_sentences_length_in_batch)
+    returns the feed dict of one batch, sentences/labels/offsets are as in batch_iter.
+    Yields (sent_batch, label_batch, sequence_length_batch, predicts).
+    """
+    batches = batch_iter(sentences, labels, sequence_lengths, idx_of_word_pad, idx_of_label_pad, batch_size=batch_size, num_epochs=1, shuffle=False, pad_to_length=pad_to_length, offsets=offsets)
+    for sent_batch, label_batch, sequence_length_batch, max_sentences_length_in_batch in batches:
+        feed_dict = get_feed_dict(sent_batch, label_batch, sequence_length_batch, max_sentences_length_in_batch)
+        predicts = sess.run(viterbi_sequence, feed_dict=feed_dict)
+        yield sent_batch, label_batch, sequence_length_batch, predicts
+
+def write_predictions(tsvfile, sent_batch, label_batch, sequence_length_batch, predicts, map_id_word, labels_template):
+    """
+    Writes one "word\tgolden_tag\tpredict_tag" line per token and a '-\tX\t-' line after each sentence.
+    """
+    for sent, label, predict, sequence_length in zip(sent_batch, label_batch, predicts, sequence_length_batch):
+        if sequence_length > 0:
+            for subidx in range(sequence_length):
+                word = get_word_from_idx(map_id_word, sent[subidx])
+                golden_tag = labels_template[label[subidx]]
+                predict_tag = labels_template[predict[subidx]]
+                tsvfile.write("%s\t%s\t%s\n" % (word, golden_tag, predict_tag))
+            tsvfile.write('-\tX\t-\n')
+
+def prefetch(items, make_item=None, buffer_size=4, n_workers=1):
+    """
+    Iterates `items` on a background thread and yields make_item(item) (or the item itself),
+    keeping at most buffer_size prepared results in a bounded queue.
+
+    Ordering and determinism: results are yielded in the order of `items` whatever n_workers is.
+    `items` is only advanced by the single producer thread, so the RNG draws it makes
+    (e.g. the shuffling of batch_iter) happen in the same order as without prefetching and a
+    seeded run produces the same batches. make_item runs on up to n_workers threads at once,
+    so it must not draw from shared RNG state. Side effects of `items` (e.g. padding_stats)
+    run up to buffer_size items ahead of the consumer.
+    Exceptions of the producer or of make_item are raised in the consumer.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    buffer = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=n_workers) if make_item is not None else None
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if executor is not None:
+                    item = executor.submit(make_item, item)
+                if not put(('item', item)):
+                    return
+            put(('done', None))
+        except BaseException as e:
+            put(('error', e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, payload = buffer.get()
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise payload
+            elif executor is not None:
+                yield payload.result()
+            else:
+                yield payload
+    finally:
+        stop.set()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+class AppendOnlyTable(object):
+    """
+    2D array growing by appended rows. The buffer grows by a quarter of its size when full,
+    so appending n rows costs O(n) amortized without doubling the memory of a large table;
+    pass the final capacity when it is known. `table` is a view of the filled rows.
+    """
+    def __init__(self, initial, capacity=None):
+        initial = np.asarray(initial)
+        capacity = max(capacity or 0, initial.shape[0], 1)
+        self._buffer = np.zeros(shape=[capacity, initial.shape[1]], dtype=initial.dtype)
+        self._buffer[:initial.shape[0]] = initial
+        self.n_rows = initial.shape[0]
+
+    @property
+    def table(self):
+        return self._buffer[:self.n_rows]
+
+    @property
+    def shape(self):
+        return (self.n_rows, self._buffer.shape[1])
+
+    def __len__(self):
+        return self.n_rows
+
+    def append(self, rows):
+        n_rows = self.n_rows + len(rows)
+        if n_rows > self._buffer.shape[0]:
+            buffer = np.zeros(shape=[max(n_rows, self._buffer.shape[0] + self._buffer.shape[0]//4 + 1), self._buffer.shape[1]], dtype=self._buffer.dtype)
+            buffer[:self.n_rows] = self.table
+            self._buffer = buffer
+        self._buffer[self.n_rows:n_rows] = rows
+        self.n_rows = n_rows
+
+    def truncate(self, n_rows):
+        # drops the rows after n_rows, the buffer is kept for the next appends
+        self.n_rows = min(n_rows, self.n_rows)
+
+class CharIndexMatrix(object):
+    """
+    [vocab_size, max_word_len] int32 matrix, row i holds
+    word_2_indices_per_char(map_id_word[i], max_word_len, char_dict).
+    Rows of new word ids are appended in amortized chunks by update().
+    """
+    def __init__(self, max_word_len, char_dict, capacity=1024):
+        self.max_word_len = max_word_len
+        self.char_dict = char_dict
+        self._rows = AppendOnlyTable(np.zeros(shape=[0, max_word_len], dtype=np.int32), capacity=capacity)
+
+    @property
+    def matrix(self):
+        return self._rows.table
+
+    @property
+    def n_words(self):
+        return len(self._rows)
+
+    def update(self, map_id_word):
+        n_words = len(map_id_word)
+        if n_words <= self.n_words:
+            return
+        rows = np.zeros(shape=[n_words - self.n_words, self.max_word_len], dtype=np.int32)
+        for idx, id_ in enumerate(range(self.n_words, n_words)):
+            rows[idx] = word_2_indices_per_char(map_id_word[id_], self.max_word_len, self.char_dict)
+        self._rows.append(rows)
+
+    def truncate(self, n_words):
+        self._rows.truncate(n_words)
+
+    def gather(self, sents, lengths, max_doc_len):
+        batch_size = sents.shape[0]
+        width = min(sents.shape[1], max_doc_len)
+        res = np.zeros(shape=[batch_size, max_doc_len, self.max_word_len], dtype=np.int32)
+        mask = np.arange(width)[np.newaxis, :] < np.asarray(lengths)[:, np.newaxis]
+        res[:, :width][mask] = self.matrix[sents[:, :width][mask]]
+        return res
+
+def build_char_index_matrix(map_id_word, max_word_len, char_dict):
+    char_index_matrix = CharIndexMatrix(max_word_len, char_dict, capacity=max(len(map_id_word), 1))
+    char_index_matrix.update(map_id_word)
+    return char_index_matrix
+
+def word_indices_to_char_indices(sents, lengths, max_doc_len, max_word_len, char_dict, map_id_word, char_index_matrix=None):
+    if char_index_matrix is not None:
+        char_index_matrix.update(map_id_word)
+        return char_index_matrix.gather(sents, lengths, max_doc_len)
+
     batch_size = sents.shape[0]
     res = np.zeros(shape=[batch_size, max_doc_len, max_word_len], dtype=np.int32)
     for idx_sent, sentence in enumerate(sents):
@@ -278,6 +812,68 @@ def load_from_file(filename, metadata = '../data_feed_model/metadata.shlv'):
             data[k] = f[k]
     return data
 
+DATA_FEED_SPLITS = ['train', 'dev']
+DATA_FEED_METADATA = ['labels_template', 'vocabs', 'char_dict', 'max_word_len']
+
+def _unpack_sequences(buffer, offsets):
+    # object array of views into buffer, no copy
+    sequences = np.empty(shape=[offsets.shape[0] - 1], dtype=object)
+    for idx in range(sequences.shape[0]):
+        sequences[idx] = buffer[offsets[idx]:offsets[idx + 1]]
+    return sequences
+
+def write_data_feed(data, dirname):
+    """
+    Columnar data feed: for each split <split>_tokens.npy, <split>_labels.npy (flat int32),
+    <split>_offsets.npy and <split>_sequence_lengths.npy, a float32 lookup_table.npy
+    and the DATA_FEED_METADATA keys in metadata.json.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    for split in DATA_FEED_SPLITS:
+        tokens, offsets = pack_sequences(data['%s_sentences' % split])
+        labels, _ = pack_sequences(data['%s_labels' % split])
+        np.save(os.path.join(dirname, '%s_tokens.npy' % split), tokens)
+        np.save(os.path.join(dirname, '%s_labels.npy' % split), labels)
+        np.save(os.path.join(dirname, '%s_offsets.npy' % split), offsets)
+        np.save(os.path.join(dirname, '%s_sequence_lengths.npy' % split), np.asarray(data['%s_sequence_lengths' % split], dtype=np.int64))
+    np.save(os.path.join(dirname, 'lookup_table.npy'), np.asarray(data['lookup_table'], dtype=np.float32))
+
+    metadata = {k: data[k] for k in DATA_FEED_METADATA}
+    with open(os.path.join(dirname, 'metadata.json'), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False)
+
+def load_data_feed(dirname, mmap_mode='r', unpack=False):
+    """
+    Loads a data feed written by write_data_feed. Token, label and lookup table arrays are
+    memory-mapped, so startup does not depend on the corpus size and jobs share one copy.
+    Returns the packed <split>_sentences_buffer, <split>_labels_buffer and <split>_offsets
+    that batch_iter accepts directly, <split>_sequence_lengths and the metadata.
+    With unpack, also the per-sentence <split>_sentences and <split>_labels views of
+    load_from_file (one object per sentence, slow on large corpora).
+    """
+    data = dict()
+    with open(os.path.join(dirname, 'metadata.json'), encoding='utf-8') as f:
+        data.update(json.load(f))
+    data['map_word_id'], data['map_id_word'] = get_map_word_id_and_map_id_word(data['vocabs'])
+
+    for split in DATA_FEED_SPLITS:
+        tokens = np.load(os.path.join(dirname, '%s_tokens.npy' % split), mmap_mode=mmap_mode)
+        labels = np.load(os.path.join(dirname, '%s_labels.npy' % split), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(dirname, '%s_offsets.npy' % split))
+        data['%s_sentences_buffer' % split] = tokens
+        data['%s_labels_buffer' % split] = labels
+        data['%s_offsets' % split] = offsets
+        if unpack:
+            data['%s_sentences' % split] = _unpack_sequences(tokens, offsets)
+            data['%s_labels' % split] = _unpack_sequences(labels, offsets)
+        data['%s_sequence_lengths' % split] = np.load(os.path.join(dirname, '%s_sequence_lengths.npy' % split))
+    data['lookup_table'] = np.load(os.path.join(dirname, 'lookup_table.npy'), mmap_mode=mmap_mode)
+    return data
+
+def convert_shelve_data_feed(filename, dirname, metadata='../data_feed_model/metadata.shlv'):
+    write_data_feed(load_from_file(filename, metadata), dirname)
+
 
 def next_lr(lr, p=0.05, t=100):
     return 1.0*lr/(1.0 + p*t)
@@ -350,40 +946,82 @@ def iob_iobes(tags):
             raise Exception('Invalid IOB format!')
     return new_tags
 
+SCHEME_PREFIXES = {'BIO': ['B', 'I'], 'BIOES': ['B', 'I', 'E', 'S']}
 
-
-def update_lookup_table_for_testing(test_sentences, lookup_table, map_id_word, map_word_id, type_embeddings):
-    n_out_of_vocabs = 0
-    out_of_vocabs = list()
-    old_n_vocabs = len(map_word_id.keys())
-    oov_map_word_id = dict()
+def get_allowed_transitions(labels_template, tag_scheme='BIO'):
+    """
+    Legal tag transitions of the BIO or BIOES scheme over the ids of labels_template.
+    Returns allowed [n_tags, n_tags] (allowed[i, j]: tag j may follow tag i), allowed_start
+    and allowed_end [n_tags] (tag may start / end a sentence). 'PAD' is never allowed,
+    tags without a prefix of the scheme are treated like 'O'.
+    """
+    if tag_scheme not in SCHEME_PREFIXES:
+        raise Exception('Wrong tagging scheme!')
+    prefixes = []
+    types = []
+    for tag in labels_template:
+        split = tag.split('-', 1)
+        if len(split) == 2 and split[0] in SCHEME_PREFIXES[tag_scheme]:
+            prefixes.append(split[0])
+            types.append(split[1])
+        else:
+            prefixes.append('PAD' if tag == 'PAD' else 'O')
+            types.append(None)
+    prefixes = np.array(prefixes)
+    types = np.array(types, dtype=object)
+    same_type = (types[:, None] == types[None]) & (types[:, None] != None)
+    not_pad = prefixes != 'PAD'
+
+    # chunk-opening or outside tags may follow any tag closing a chunk, I/E only continue a chunk of their type
+    is_free = np.isin(prefixes, ['O', 'B', 'S'])
+    is_continuation = np.isin(prefixes, ['I', 'E'])
+    if tag_scheme == 'BIO':
+        allowed = is_free[None] | (is_continuation[None] & same_type)
+        allowed_end = not_pad.copy()
+    else:
+        is_open = np.isin(prefixes, ['B', 'I'])
+        allowed = np.where(is_open[:, None], is_continuation[None] & same_type, is_free[None])
+        allowed_end = np.isin(prefixes, ['O', 'E', 'S'])
+    allowed &= not_pad[:, None] & not_pad[None]
+    return allowed, is_free, allowed_end
+
+
+def update_lookup_table_for_testing(test_sentences, lookup_table, map_id_word, map_word_id, type_embeddings, char_index_matrix=None, oov_backend='random', seed=None):
+    """
+    Adds the words of test_sentences missing from map_word_id to map_word_id/map_id_word
+    and appends their vectors (see lookup_word_vectors, seeded with seed) to the lookup table.
+    lookup_table is either an array, copied once into an AppendOnlyTable sized for the new words,
+    or an AppendOnlyTable which is extended in place, so repeated calls only cost time for the new words.
+    Returns the updated table.
+    """
+    out_of_vocabs = dict()
     for sent in test_sentences:
         for word in sent:
             if word not in map_word_id:
-                oov_map_word_id[word] = n_out_of_vocabs
-                n_out_of_vocabs += 1
-                out_of_vocabs.append(word)
+                out_of_vocabs[word] = True
+    out_of_vocabs = list(out_of_vocabs)
+
+    if not isinstance(lookup_table, AppendOnlyTable):
+        lookup_table = AppendOnlyTable(lookup_table, capacity=len(lookup_table) + len(out_of_vocabs))
+    assert len(lookup_table) == len(map_word_id)
 
     #update map_id_word and map_word_id
+    old_n_vocabs = len(map_word_id)
     for idx, word in enumerate(out_of_vocabs):
         map_word_id[word] = idx + old_n_vocabs
         map_id_word[idx + old_n_vocabs] = word
 
     #update lookup table
-    dims = lookup_table.shape[1]
-    updated_lookup_table = np.zeros(shape=[lookup_table.shape[0] + n_out_of_vocabs, dims])
-
-    oov_lookup_table = generate_lookup_word_embedding(out_of_vocabs, oov_map_word_id, type_embeddings=type_embeddings)
-    for idx in range(lookup_table.shape[0]):
-        updated_lookup_table[idx, :] = lookup_table[idx, :]
+    oov_vectors, _ = lookup_word_vectors(out_of_vocabs, type_embeddings, seed=seed, dims=lookup_table.shape[1], oov_backend=oov_backend)
+    lookup_table.append(oov_vectors)
 
-    for idx, word in enumerate(oov_lookup_table):
-        updated_lookup_table[idx + old_n_vocabs, :] = oov_lookup_table[idx, :]
+    if char_index_matrix is not None:
+        char_index_matrix.update(map_id_word)
 
-    return updated_lookup_table
+    return lookup_table.table
 
 
-def get_feed_dict_for_testting(test_sentences, test_labels, test_sequence_lengths, max_word_len, char_dict, labels_template, updated_lookup_table, map_id_word, map_word_id, type_embeddings, tagging):
+def get_feed_dict_for_testting(test_sentences, test_labels, test_sequence_lengths, max_word_len, char_dict, labels_template, updated_lookup_table, map_id_word, map_word_id, type_embeddings, tagging, char_index_matrix=None):
 
     dims = updated_lookup_table.shape[1]
 
@@ -404,7 +1042,7 @@ def get_feed_dict_for_testting(test_sentences, test_labels, test_sequence_length
             id_of_word = map_word_id[word]
             vectors[0, subidx, :] = updated_lookup_table[id_of_word, :]
 
-        chars_indices = word_indices_to_char_indices(sent, sequence_length, max_sentences_length_in_batch, max_word_len, char_dict, map_id_word)
+        chars_indices = word_indices_to_char_indices(sent, sequence_length, max_sentences_length_in_batch, max_word_len, char_dict, map_id_word, char_index_matrix)
         feed_dict = {
                 "labels_placeholder": label,
                 "vectors": vectors,
@@ -417,14 +1055,52 @@ def get_feed_dict_for_testting(test_sentences, test_labels, test_sequence_length
         yield feed_dict
     
 
+def _get_test_batch(batch, max_word_len, char_dict, map_label_id, lookup_table, map_id_word, map_word_id, char_index_matrix):
+    sequence_lengths = np.array([length for _, _, length in batch], dtype=np.int64)
+    max_sentences_length_in_batch = sequence_lengths.max()
+
+    sents = np.full(shape=[len(batch), max_sentences_length_in_batch], fill_value=map_word_id[''], dtype=np.int32)
+    labels = np.full(shape=[len(batch), max_sentences_length_in_batch], fill_value=map_label_id['PAD'], dtype=np.int32)
+    for idx, (sent, label, length) in enumerate(batch):
+        sents[idx, :length] = [map_word_id[word] for word in sent]
+        labels[idx, :length] = [map_label_id[sublabel] for sublabel in label]
+
+    vectors = lookup_table.take(sents, axis=0).astype(np.float32, copy=False)
+    chars_indices = word_indices_to_char_indices(sents, sequence_lengths, max_sentences_length_in_batch, max_word_len, char_dict, map_id_word, char_index_matrix)
+    return {
+            "labels_placeholder": labels,
+            "vectors": vectors,
+            "sequence_lengths_placeholder": sequence_lengths,
+            "chars_placeholder": chars_indices,
+            "max_sentences_length_placeholder": max_sentences_length_in_batch,
+            "dropout_prob_placeholder": 1.0
+            }
+
+def get_batched_feed_dict_for_testing(test_corpus, max_word_len, char_dict, labels_template, updated_lookup_table, map_id_word, map_word_id, batch_size=64, char_index_matrix=None):
+    """
+    Batched version of get_feed_dict_for_testting.
+    test_corpus is an iterable of (sentence, label, length), e.g. iter_corpus_tsv('../test_tsv'),
+    it is consumed lazily so only one batch is held in memory.
+    Yields (batch, feed_dict) where batch is the list of (sentence, label, length) of the feed dict.
+    """
+    map_label_id = {label: idx for idx, label in enumerate(labels_template)}
+    batch = []
+    for item in test_corpus:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch, _get_test_batch(batch, max_word_len, char_dict, map_label_id, updated_lookup_table, map_id_word, map_word_id, char_index_matrix)
+            batch = []
+    if len(batch) > 0:
+        yield batch, _get_test_batch(batch, max_word_len, char_dict, map_label_id, updated_lookup_table, map_id_word, map_word_id, char_index_matrix)
+
 
 if __name__ == '__main__':
     def init_metadata():
         
-        sentences, labels, sequence_lengths = readFileTSV()
+        sentences, labels, sequence_lengths = readFileTSV(n_workers=os.cpu_count())
         # max_doc_len = get_max_doc_len(sequence_lengths)
         # add_padding(sentences, labels, sequence_lengths, max_doc_len)
-        vocabs = get_vocabs(sentences)
+        vocabs, word_counts = get_vocabs_with_counts(sentences)
         
         train_idx, dev_idx = get_idx_train_dev(sentences,train_ratio=0.8)
         map_word_id, map_id_word = get_map_word_id_and_map_id_word(vocabs)
@@ -438,6 +1114,7 @@ if __name__ == '__main__':
             f['sequence_lengths'] = sequence_lengths
 
             f['vocabs'] = vocabs
+            f['word_counts'] = word_counts
             f['map_word_id']= map_word_id
             f['map_id_word'] = map_id_word
             f['train_idx'] = train_idx
@@ -454,7 +1131,8 @@ if __name__ == '__main__':
             map_word_id = f['map_word_id']
             train_idx = f['train_idx'] 
             dev_idx = f['dev_idx']
-        
+            char_dict = f['char_dict']
+            max_word_len = f['max_word_len']
 
         
         labels_updated = np.empty_like(labels)
@@ -462,12 +1140,11 @@ if __name__ == '__main__':
 
 
         if tagging == 'BIO':
-            lookup_table = generate_lookup_word_embedding(vocabs, map_word_id, type_embeddings=type_embeddings)
+            lookup_table = generate_lookup_word_embedding(vocabs, map_word_id, type_embeddings=type_embeddings, seed=LOOKUP_TABLE_SEED)
         else: #BIOES
-            with shelve.open("../data_feed_model/%s_BIO.shlv" % (type_embeddings)) as f:
-                lookup_table = f['lookup_table']
+            lookup_table = np.load("../data_feed_model/%s_BIO/lookup_table.npy" % (type_embeddings))
             update_tag_scheme(labels_updated, sequence_lengths)
-        labels_template = get_labels_template(labels)
+        labels_template = get_labels_template(labels_updated)
         encoded_labels = encode_labels(labels_updated, labels_template) #chứa labels dạng số 
         encoded_sentences = encode_sentences(sentences, map_word_id)
 
@@ -479,13 +1156,15 @@ if __name__ == '__main__':
         
         data['labels_template'] = labels_template
         data['lookup_table'] = lookup_table
-        write_to_file(data, "../data_feed_model/%s_%s.shlv" % (type_embeddings, tagging))
+        data['vocabs'] = vocabs
+        data['char_dict'] = char_dict
+        data['max_word_len'] = max_word_len
+        write_data_feed(data, "../data_feed_model/%s_%s" % (type_embeddings, tagging))
 
 
     # with shelve.open('../data_feed_model/metadata.shlv') as f:
     #     print(f['sentences'].shape[0])
     # init_metadata()
-    OOV_dict = dict()
     for type_embeddings in ['bio-word2vec']:
         for tagging in ['BIO']:
             preprocess(type_embeddings, tagging)
@@ -0,0 +1,44 @@
+"""
+CPU training throughput of bilstm-cnns-crf.py for several thread and tower counts.
+
+    python benchmark_cpu_scaling.py <type_embeddings> <tagging> [max_steps]
+
+Every configuration trains max_steps steps in a fresh process (TASK1_MAX_STEPS, nothing is
+saved), the sentences/s are compared to the single thread, single tower run.
+"""
+import os
+import re
+import sys
+import subprocess
+
+type_embeddings = sys.argv[1].strip()
+tagging = sys.argv[2].strip()
+max_steps = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+n_cores = os.cpu_count()
+thread_counts = sorted(set([n for n in [1, 2, 4, 8, 16, 32, 64] if n <= n_cores] + [n_cores]))
+tower_counts = [n for n in [1, 2, 4] if n <= n_cores]
+
+def run(n_threads, n_towers):
+    # one inter-op thread per tower so the towers run side by side, their ops share the intra-op pool of n_threads
+    env = dict(os.environ, TASK1_DEVICE='/cpu:0', TASK1_MAX_STEPS=str(max_steps), TASK1_NUM_TOWERS=str(n_towers), \
+               TASK1_INTRA_OP_THREADS=str(n_threads), TASK1_INTER_OP_THREADS=str(n_towers))
+    output = subprocess.run([sys.executable, 'bilstm-cnns-crf.py', type_embeddings, tagging], env=env, \
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+    match = re.search(r"Trained \d+ steps in [\d.]+s, ([\d.]+) sentences/s", output)
+    if match is None:
+        print(output)
+        raise Exception('No throughput in the output of %d threads, %d towers' % (n_threads, n_towers))
+    return float(match.group(1))
+
+print("threads\ttowers\tsentences/s\tspeedup")
+baseline = None
+for n_threads in thread_counts:
+    for n_towers in tower_counts:
+        if n_towers > n_threads:
+            continue
+        throughput = run(n_threads, n_towers)
+        if baseline is None:
+            baseline = throughput
+        print("%d\t%d\t%.1f\t%.2fx" % (n_threads, n_towers, throughput, throughput/baseline))
+        sys.stdout.flush()
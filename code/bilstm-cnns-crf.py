@@ -1,10 +1,14 @@
 import os
+import json
 import shelve
 import numpy as np
 import tensorflow as tf
 from time import time
-from Task1_datahelper import load_from_file, word_2_indices_per_char, decode_labels, batch_iter, get_word_from_idx, word_indices_to_char_indices, next_lr
+from Task1_datahelper import load_data_feed, word_2_indices_per_char, decode_labels, batch_iter, get_word_from_idx, word_indices_to_char_indices, next_lr, build_char_index_matrix, predict_in_batches, write_predictions, prefetch, get_allowed_transitions, get_batch_iter_state, save_batch_iter_state, load_batch_iter_state, get_rare_rows
+from Task1_tfhelper import make_train_dataset, get_bucket_boundaries, export_inference_graph, constrain_crf_scores, get_learning_rate, clip_gradients, sum_tower_gradients
+from my_eval import chunk_scores
 from math import sqrt
+import itertools
 import sys
 
 type_embeddings = sys.argv[1].strip()
@@ -15,24 +19,27 @@ print("Type embeddings: %s " % type_embeddings)
 print("Tagging: %s" % tagging)
 
 
-data = load_from_file("../data_feed_model/%s_%s.shlv" % (type_embeddings, tagging))
+data = load_data_feed("../data_feed_model/%s_%s" % (type_embeddings, tagging))
 
 
 max_word_len = data['max_word_len']
 labels_template = data['labels_template']
 
-train_sentences = data["train_sentences"]
-train_labels = data["train_labels"]
+train_sentences = data["train_sentences_buffer"]
+train_labels = data["train_labels_buffer"]
+train_offsets = data["train_offsets"]
 train_sequence_lengths = data["train_sequence_lengths"]
 
-dev_sents = data["dev_sentences"]
-dev_labels = data["dev_labels"]
+dev_sents = data["dev_sentences_buffer"]
+dev_labels = data["dev_labels_buffer"]
+dev_offsets = data["dev_offsets"]
 dev_sequence_lengths = data["dev_sequence_lengths"]
 
 word_lookup_table = data['lookup_table']
 map_word_id = data['map_word_id']
 map_id_word = data['map_id_word']
 char_dict = data['char_dict']
+char_index_matrix = build_char_index_matrix(map_id_word, max_word_len, char_dict)
 
 char_embedding_size = 16
 char_representation_size = 30
@@ -41,133 +48,373 @@ hidden_size_lstm = 200
 dropout_prob = 0.5
 n_epochs = 50
 batch_size = 10
-n_batches = int(train_sentences.shape[0]//batch_size) + 1
+bucket_size = 20 # batches per length-sorted window, None for plain random batches
+eval_batch_size = 64
+prefetch_batches = 8 # feed dicts prepared ahead of sess.run
+prefetch_workers = 2
+input_mode = 'feed_dict' # or 'dataset' for the tf.data pipeline, whose epochs are n_batches steps only without bucketing (see make_train_dataset)
+constrained_decoding = False # only decode sequences legal in the tagging scheme (no I-X after O, ...)
+checkpoint_every_steps = 2000 # periodic checkpoints in model_folder/checkpoints, None to disable
+checkpoint_every_minutes = 30 # None to disable
+max_checkpoints_to_keep = 3
+train_metrics_every_steps = 100 # decode one training batch every N steps for the accuracy/F1 of the epoch print, None to never decode
+eval_every_epochs = 1 # entity F1 on the dev split, the best model is kept in model_folder/best
+early_stopping_patience = 5 # evaluations without dev F1 improvement before stopping, None to always run n_epochs
+n_batches = (train_sequence_lengths.shape[0] + batch_size - 1)//batch_size # batches per epoch, the last one may be partial
 learning_rate = 0.015
+lr_schedule = 'inverse_time' # 'constant', 'inverse_time' (learning_rate/(1 + lr_decay*epoch)), 'step' or 'cosine'
+lr_decay = 0.05
+lr_step_epochs = 10 # 'step': learning rate times lr_step_gamma every lr_step_epochs epochs
+lr_step_gamma = 0.5
+lr_min = 0.0 # 'cosine': learning rate at the last epoch
+lr_warmup_steps = 0
 momentum = 0.9
-gradient_limit = 5.0
+gradient_limit = 5.0 # 'dense' gradients: clip by value
+gradient_mode = 'sparse' # 'sparse': clip by global norm, the word embedding gradient stays sparse (see clip_gradients), or 'dense'
+clip_norm = 5.0 # 'sparse' gradients: clip by global norm
+freeze_min_count = None # 'sparse' gradients: embedding rows of words seen less than this in the training split are not updated
+
+# execution settings, from the environment so benchmark_cpu_scaling.py can vary them
+device = os.environ.get('TASK1_DEVICE', '/device:gpu:0') # '/cpu:0' to train on CPU only
+intra_op_threads = int(os.environ.get('TASK1_INTRA_OP_THREADS', 0)) # threads of a single op (matmul, LSTM step), 0 for TF's default
+inter_op_threads = int(os.environ.get('TASK1_INTER_OP_THREADS', 0)) # ops run at once, 0 for TF's default
+num_towers = int(os.environ.get('TASK1_NUM_TOWERS', 1)) # data-parallel replicas, each batch is split across them
+max_steps = int(os.environ['TASK1_MAX_STEPS']) if 'TASK1_MAX_STEPS' in os.environ else None # benchmark: stop after max_steps steps, nothing is saved
+on_gpu = 'gpu' in device.lower()
+tower_devices = ['/device:gpu:%d' % tower for tower in range(num_towers)] if on_gpu else [device]*num_towers
 
 label_train = dict()
 label_dev = dict()
 
-
-chars_placeholder = tf.placeholder(tf.int32, shape=[None, None, max_word_len], name="characters")
-sentences_placeholder = tf.placeholder(tf.int32, shape=[None, None], name='sentences')
-labels_placeholder = tf.placeholder(tf.int32, shape=[None, None], name='labels')
-sequence_lengths_placeholder = tf.placeholder(tf.int32, shape=[None], name='lengths')
+saved_model_folder = '../saved_model/'
+model_folder = os.path.join(saved_model_folder, '%s-%s' % (type_embeddings, tagging))
+checkpoint_folder = os.path.join(model_folder, 'checkpoints')
+best_folder = os.path.join(model_folder, 'best')
+latest_checkpoint = tf.train.latest_checkpoint(checkpoint_folder) if max_steps is None else None
+
+
+if input_mode == 'dataset':
+    # the pipeline cannot restart mid-epoch, a resumed run only does the epochs left
+    n_dataset_epochs = n_epochs
+    if latest_checkpoint is not None:
+        n_dataset_epochs -= int(tf.train.load_variable(latest_checkpoint, 'global_step')) // n_batches
+    train_dataset = make_train_dataset(train_sentences, train_labels, train_offsets, train_sequence_lengths, char_index_matrix, \
+                                        map_word_id[''], labels_template.index('PAD'), batch_size, n_dataset_epochs, shuffle=True, \
+                                        bucket_boundaries=get_bucket_boundaries(train_sequence_lengths) if bucket_size is not None else None)
+    next_sentences, next_labels, next_chars, next_lengths = train_dataset.make_one_shot_iterator().get_next()
+    # the placeholders default to the next training batch and can still be fed by name
+    chars_placeholder = tf.placeholder_with_default(next_chars, shape=[None, None, max_word_len], name="characters")
+    sentences_placeholder = tf.placeholder_with_default(next_sentences, shape=[None, None], name='sentences')
+    labels_placeholder = tf.placeholder_with_default(next_labels, shape=[None, None], name='labels')
+    sequence_lengths_placeholder = tf.placeholder_with_default(next_lengths, shape=[None], name='lengths')
+    max_sentences_length_placeholder = tf.placeholder_with_default(tf.shape(sentences_placeholder)[1], shape=(), name='max_sentences_length_in_batch')
+else:
+    chars_placeholder = tf.placeholder(tf.int32, shape=[None, None, max_word_len], name="characters")
+    sentences_placeholder = tf.placeholder(tf.int32, shape=[None, None], name='sentences')
+    labels_placeholder = tf.placeholder(tf.int32, shape=[None, None], name='labels')
+    sequence_lengths_placeholder = tf.placeholder(tf.int32, shape=[None], name='lengths')
+    max_sentences_length_placeholder = tf.placeholder(tf.int32, name='max_sentences_length_in_batch')
 dropout_prob_placeholder = tf.placeholder_with_default(1.0, shape=(), name='dropout')
-lr_placeholer = tf.placeholder(tf.float64, name='lr')
-max_sentences_length_placeholder = tf.placeholder(tf.int32, name='max_sentences_length_in_batch')
 
+def build_tagger(chars, sentences, sequence_lengths, max_sentences_length, device):
+    """
+    Char CNN + BiLSTM emission scores of a batch. The variables are shared by every call, so
+    the towers of the data-parallel mode are replicas of the same model.
+    Returns the word embedding variable, the word vectors and the logits.
+    """
+    with tf.device(device), tf.variable_scope('char-embedding', reuse=tf.AUTO_REUSE):
+        W_char_embedding = tf.get_variable(name="char-embedding", \
+                                            initializer=tf.constant_initializer(np.random.uniform(-sqrt(3.0/char_embedding_size), sqrt(3.0/char_embedding_size))),\
+                                            shape=[len(char_dict.keys()), char_embedding_size], trainable=True)
+        char_embedding = tf.nn.embedding_lookup(W_char_embedding, chars)
+        char_embedding = tf.nn.dropout(char_embedding, dropout_prob_placeholder)
+    with tf.device(device), tf.variable_scope('char-cnn', reuse=tf.AUTO_REUSE):
+        window_size = 3
+
+        filter_shape = [1, window_size, char_embedding_size, char_representation_size]
+        initilizer = tf.constant_initializer(np.random.uniform(-sqrt(6.0/(char_embedding_size + char_representation_size)), sqrt(6.0/(char_embedding_size + char_representation_size))))
+        W = tf.get_variable(name='W', shape=filter_shape, initializer=initilizer)
+        conv = tf.nn.conv2d(char_embedding, W, strides=[1, 1, 1, 1], padding='SAME', name='conv')
+
+        relu = tf.nn.relu(conv, name='relu')
+
+        pool = tf.nn.max_pool(relu, ksize=[1, 1, max_word_len, 1], 
+                                  strides = [1, 1, max_word_len, 1], padding='VALID', name='pool')
+
+        char_representation = tf.reshape(pool, [-1, max_sentences_length, char_representation_size])
+
+    with tf.device(device), tf.variable_scope('word-embedding', reuse=tf.AUTO_REUSE):
+        # the initializer only runs when the variable is created, the table is not copied into the graph by every tower
+        W_embedding = tf.get_variable(name='word-embedding', shape=word_lookup_table.shape, dtype=tf.float32, \
+                                      initializer=tf.constant_initializer(word_lookup_table), trainable=True)
+        vectors = tf.nn.embedding_lookup(W_embedding, sentences, name='vectors')
+        word_embedding_with_char_representation = tf.concat([vectors, char_representation], axis=2)
+        word_embedding_with_char_representation = tf.nn.dropout(word_embedding_with_char_representation, dropout_prob_placeholder)
+    with tf.device(device), tf.variable_scope("bi-lstm", reuse=tf.AUTO_REUSE):
+        cell_fw = tf.contrib.rnn.LSTMCell(hidden_size_lstm)
+        cell_bw = tf.contrib.rnn.LSTMCell(hidden_size_lstm)
+        (output_fw, output_bw), _ = tf.nn.bidirectional_dynamic_rnn( \
+                                    cell_fw, cell_bw, word_embedding_with_char_representation, \
+                                    sequence_length=sequence_lengths, dtype=tf.float32)
+        output = tf.concat([output_fw, output_bw], axis=-1)
+        output = tf.nn.dropout(output, dropout_prob_placeholder)
+
+    with tf.device(device), tf.variable_scope("projection", reuse=tf.AUTO_REUSE):
+        r_plus_c = 2*hidden_size_lstm + num_classes
+        W = tf.get_variable("W", dtype=tf.float32, initializer=tf.constant_initializer(np.random.uniform(-sqrt(6.0/r_plus_c), sqrt(6.0/r_plus_c))),\
+                                                        shape=[2*hidden_size_lstm, num_classes])
+
+        b = tf.get_variable("b", shape=[num_classes],dtype=tf.float32, initializer=tf.constant_initializer(0.0))
+
+        output = tf.reshape(output, [-1, 2*hidden_size_lstm])
+        pred = tf.matmul(output, W) + b
+       
+        logits = tf.reshape(pred, [-1, max_sentences_length, num_classes])
+    return W_embedding, vectors, logits
+
+# the full batch graph, used for decoding, evaluation and export, and for training with a single tower
+W_embedding, vectors, logits = build_tagger(chars_placeholder, sentences_placeholder, sequence_lengths_placeholder, max_sentences_length_placeholder, device)
 print(chars_placeholder.name)
-with tf.device("/device:gpu:0"), tf.variable_scope('char-embedding', reuse=tf.AUTO_REUSE):
-    W_char_embedding = tf.get_variable(name="char-embedding", \
-                                        initializer=tf.constant_initializer(np.random.uniform(-sqrt(3.0/char_embedding_size), sqrt(3.0/char_embedding_size))),\
-                                        shape=[len(char_dict.keys()), char_embedding_size], trainable=True)
-    char_embedding = tf.nn.embedding_lookup(W_char_embedding, chars_placeholder)
-    char_embedding = tf.nn.dropout(char_embedding, dropout_prob_placeholder)
-with tf.device("/device:gpu:0"), tf.variable_scope('char-cnn', reuse=tf.AUTO_REUSE):
-    window_size = 3
-
-    filter_shape = [1, window_size, char_embedding_size, char_representation_size]
-    initilizer = tf.constant_initializer(np.random.uniform(-sqrt(6.0/(char_embedding_size + char_representation_size)), sqrt(6.0/(char_embedding_size + char_representation_size))))
-    W = tf.get_variable(name='W', shape=filter_shape, initializer=initilizer)
-    conv = tf.nn.conv2d(char_embedding, W, strides=[1, 1, 1, 1], padding='SAME', name='conv')
-
-    relu = tf.nn.relu(conv, name='relu')
-
-    pool = tf.nn.max_pool(relu, ksize=[1, 1, max_word_len, 1], 
-                              strides = [1, 1, max_word_len, 1], padding='VALID', name='pool')
-
-    char_representation = tf.reshape(pool, [-1, max_sentences_length_placeholder, char_representation_size])
-
-with tf.device("/device:gpu:0"), tf.variable_scope('word-embedding'):
-    W_embedding = tf.Variable(name='word-embedding', initial_value=word_lookup_table, dtype=tf.float32, trainable=True)
-    vectors = tf.nn.embedding_lookup(W_embedding, sentences_placeholder, name='vectors')
-    word_embedding_with_char_representation = tf.concat([vectors, char_representation], axis=2)
-    word_embedding_with_char_representation = tf.nn.dropout(word_embedding_with_char_representation, dropout_prob_placeholder)
-    print('\n\n\n')
-    print(vectors.name)
-    print('\n\n\n')
-with tf.device("/device:gpu:0"), tf.variable_scope("bi-lstm"):
-    cell_fw = tf.contrib.rnn.LSTMCell(hidden_size_lstm)
-    cell_bw = tf.contrib.rnn.LSTMCell(hidden_size_lstm)
-    (output_fw, output_bw), _ = tf.nn.bidirectional_dynamic_rnn( \
-                                cell_fw, cell_bw, word_embedding_with_char_representation, \
-                                sequence_length=sequence_lengths_placeholder, dtype=tf.float32)
-    output = tf.concat([output_fw, output_bw], axis=-1)
-    output = tf.nn.dropout(output, dropout_prob_placeholder)
-
-with tf.device("/device:gpu:0"), tf.variable_scope("projection", reuse=tf.AUTO_REUSE):
-    r_plus_c = 2*hidden_size_lstm + num_classes
-    W = tf.get_variable("W", dtype=tf.float32, initializer=tf.constant_initializer(np.random.uniform(-sqrt(6.0/r_plus_c), sqrt(6.0/r_plus_c))),\
-                                                    shape=[2*hidden_size_lstm, num_classes])
+print(vectors.name)
 
-    b = tf.get_variable("b", shape=[num_classes],dtype=tf.float32, initializer=tf.constant_initializer(0.0))
-
-    output = tf.reshape(output, [-1, 2*hidden_size_lstm])
-    pred = tf.matmul(output, W) + b
-   
-    logits = tf.reshape(pred, [-1, max_sentences_length_placeholder, num_classes])
-
-with tf.device("/device:gpu:0"), tf.name_scope('crf_encode'):
+with tf.device(device), tf.name_scope('crf_encode'):
 
     log_likelihood, trans_params = tf.contrib.crf.crf_log_likelihood(logits, labels_placeholder, sequence_lengths_placeholder)
     loss = tf.reduce_mean(-log_likelihood)
-with tf.device("/device:gpu:0"), tf.name_scope('crf_decode'):
-    viterbi_sequence, viterbi_score = tf.contrib.crf.crf_decode(logits, trans_params, sequence_lengths_placeholder)
+with tf.device(device), tf.name_scope('crf_decode'):
+    if constrained_decoding:
+        decode_logits, decode_trans_params = constrain_crf_scores(logits, trans_params, sequence_lengths_placeholder, \
+                                                                  get_allowed_transitions(labels_template, tagging))
+    else:
+        decode_logits, decode_trans_params = logits, trans_params
+    viterbi_sequence, viterbi_score = tf.contrib.crf.crf_decode(decode_logits, decode_trans_params, sequence_lengths_placeholder)
 
     print('\n\n\n')
     print(viterbi_sequence.name)
     print('\n\n\n')
 
-with tf.device("/device:gpu:0"), tf.name_scope('optimizer'):
-    optimizer = tf.train.MomentumOptimizer(learning_rate=learning_rate, momentum=momentum)
-
-    gvs = optimizer.compute_gradients(loss)
-    capped_gvs = [(tf.clip_by_value(grad, -gradient_limit, gradient_limit), var) for grad, var in gvs]
-    train_op = optimizer.apply_gradients(capped_gvs)
-
-config = tf.ConfigProto(allow_soft_placement = True)
+with tf.device(device), tf.name_scope('optimizer'):
+    global_step = tf.train.get_or_create_global_step()
+    scheduled_learning_rate = get_learning_rate(global_step, lr_schedule, learning_rate, n_batches, n_epochs, decay_rate=lr_decay, \
+                                                step_epochs=lr_step_epochs, step_gamma=lr_step_gamma, min_lr=lr_min, warmup_steps=lr_warmup_steps)
+    optimizer = tf.train.MomentumOptimizer(learning_rate=scheduled_learning_rate, momentum=momentum)
+
+if num_towers == 1:
+    train_loss = loss
+    with tf.device(device), tf.name_scope('optimizer'):
+        gvs = optimizer.compute_gradients(loss)
+else:
+    # tower i gets the sentences i, i + num_towers, ... of the batch (padded to the batch length), the gradients
+    # of the summed tower losses are added and divided by the batch size, the gradient of the mean loss
+    tower_gvs = []
+    tower_losses = []
+    for tower, tower_device in enumerate(tower_devices):
+        with tf.name_scope('tower_%d' % tower):
+            tower_idx = tf.range(tower, tf.shape(sequence_lengths_placeholder)[0], num_towers)
+            tower_lengths = tf.gather(sequence_lengths_placeholder, tower_idx)
+            _, _, tower_logits = build_tagger(tf.gather(chars_placeholder, tower_idx), tf.gather(sentences_placeholder, tower_idx), \
+                                              tower_lengths, max_sentences_length_placeholder, tower_device)
+            with tf.device(tower_device):
+                tower_log_likelihood, _ = tf.contrib.crf.crf_log_likelihood(tower_logits, tf.gather(labels_placeholder, tower_idx), tower_lengths, \
+                                                                            transition_params=trans_params)
+                tower_losses.append(tf.reduce_sum(-tower_log_likelihood))
+                tower_gvs.append(optimizer.compute_gradients(tower_losses[-1]))
+    with tf.device(device), tf.name_scope('optimizer'):
+        n_sentences = tf.cast(tf.shape(sequence_lengths_placeholder)[0], tf.float32)
+        train_loss = tf.add_n(tower_losses)/n_sentences
+        gvs = sum_tower_gradients(tower_gvs, 1.0/n_sentences)
+
+with tf.device(device), tf.name_scope('optimizer'):
+    frozen_rows = dict()
+    if freeze_min_count is not None:
+        frozen_rows[W_embedding] = get_rare_rows(train_sentences, word_lookup_table.shape[0], freeze_min_count)
+        print("Frozen embedding rows: %d/%d" % (frozen_rows[W_embedding].sum(), word_lookup_table.shape[0]))
+    capped_gvs = clip_gradients(gvs, gradient_mode, gradient_limit=gradient_limit, clip_norm=clip_norm, frozen_rows=frozen_rows)
+    train_op = optimizer.apply_gradients(capped_gvs, global_step=global_step)
+
+config = tf.ConfigProto(allow_soft_placement = True, intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads)
+if not on_gpu:
+    config.device_count['GPU'] = 0
 
 with tf.Session(config = config) as sess:
     sess.run( tf.global_variables_initializer())
+
+    # resume from the latest periodic checkpoint and, with its sidecar, from the same batch_iter position
+    checkpoint_saver = tf.train.Saver(max_to_keep=max_checkpoints_to_keep)
+    # take over the checkpoints of the previous runs so max_to_keep also deletes those
+    checkpoint_state = tf.train.get_checkpoint_state(checkpoint_folder)
+    if checkpoint_state is not None:
+        checkpoint_saver.recover_last_checkpoints(checkpoint_state.all_model_checkpoint_paths)
+    resume_state = None
+    if latest_checkpoint is not None:
+        checkpoint_saver.restore(sess, latest_checkpoint)
+        if os.path.isfile(latest_checkpoint + '.batch_iter.npz'):
+            resume_state = load_batch_iter_state(latest_checkpoint + '.batch_iter.npz')
+        print("Resuming from %s (step %d)" % (latest_checkpoint, sess.run(global_step)))
     print("Training: Start")
 
-    step = 0
-    batches = batch_iter(train_sentences, train_labels, train_sequence_lengths, map_word_id[''], labels_template.index('PAD'), batch_size=batch_size, num_epochs=n_epochs, shuffle=True)
-    timer = time()
-    for batch in batches: 
+    step = sess.run(global_step)
+    padding_stats = dict()
+    iter_state = dict()
+    batches = batch_iter(train_sentences, train_labels, train_sequence_lengths, map_word_id[''], labels_template.index('PAD'), batch_size=batch_size, num_epochs=n_epochs, shuffle=True, offsets=train_offsets, bucket_size=bucket_size, padding_stats=padding_stats, \
+                            iter_state=iter_state, resume_state=resume_state)
+
+    def save_checkpoint():
+        if not os.path.isdir(checkpoint_folder):
+            os.makedirs(checkpoint_folder)
+        checkpoint = checkpoint_saver.save(sess, os.path.join(checkpoint_folder, 'ckpt'), global_step=step)
+        if input_mode != 'dataset':
+            save_batch_iter_state(checkpoint + '.batch_iter.npz', get_batch_iter_state(iter_state, step))
+        # sidecars of the checkpoints deleted by max_to_keep
+        for filename in os.listdir(checkpoint_folder):
+            if filename.endswith('.batch_iter.npz') and not tf.train.checkpoint_exists(os.path.join(checkpoint_folder, filename[:-len('.batch_iter.npz')])):
+                os.remove(os.path.join(checkpoint_folder, filename))
+
+    def get_train_feed_dict(batch):
         sent_batch, label_batch, sequence_length_batch, max_sentences_length_in_batch = batch
-        loss_, _, predicts = sess.run([loss, train_op, viterbi_sequence], feed_dict={
-                                                                                dropout_prob_placeholder: dropout_prob,
-                                                                                sentences_placeholder: sent_batch, 
-                                                                                labels_placeholder: label_batch, 
-                                                                                sequence_lengths_placeholder: sequence_length_batch,
-                                                                                max_sentences_length_placeholder: max_sentences_length_in_batch,
-                                                                                chars_placeholder: word_indices_to_char_indices(sent_batch, \
-                                                                                        sequence_length_batch, max_sentences_length_in_batch, max_word_len, char_dict, map_id_word)
-                                                                                
-                                                                            })
+        return {dropout_prob_placeholder: dropout_prob,
+                sentences_placeholder: sent_batch,
+                labels_placeholder: label_batch,
+                sequence_lengths_placeholder: sequence_length_batch,
+                max_sentences_length_placeholder: max_sentences_length_in_batch,
+                chars_placeholder: word_indices_to_char_indices(sent_batch, \
+                        sequence_length_batch, max_sentences_length_in_batch, max_word_len, char_dict, map_id_word, char_index_matrix)
+                }
+
+    if input_mode == 'dataset':
+        feed_dicts = itertools.repeat({dropout_prob_placeholder: dropout_prob})
+    else:
+        # char_index_matrix is complete for the training vocabulary, so workers only read it
+        feed_dicts = prefetch(batches, get_train_feed_dict, buffer_size=prefetch_batches, n_workers=prefetch_workers)
+
+    def reset_tagging_metrics():
+        return {'correct': 0, 'tokens': 0, 'labels': [], 'predicts': [], 'lengths': []}
+
+    def update_tagging_metrics(metrics, label_batch, sequence_length_batch, predicts):
+        mask = np.arange(label_batch.shape[1])[None] < sequence_length_batch[:, None]
+        metrics['correct'] += int(((predicts == label_batch) & mask).sum())
+        metrics['tokens'] += int(mask.sum())
+        for label, predict, sequence_length in zip(label_batch, predicts, sequence_length_batch):
+            metrics['labels'].append([labels_template[idx] for idx in label[:sequence_length]])
+            metrics['predicts'].append([labels_template[idx] for idx in predict[:sequence_length]])
+            metrics['lengths'].append(sequence_length)
+
+    def get_dev_feed_dict(sent_batch, label_batch, sequence_length_batch, max_sentences_length_in_batch):
+        return {sentences_placeholder: sent_batch,
+                labels_placeholder: label_batch,
+                sequence_lengths_placeholder: sequence_length_batch,
+                chars_placeholder: word_indices_to_char_indices(sent_batch, sequence_length_batch, max_sentences_length_in_batch, max_word_len, char_dict, map_id_word, char_index_matrix),
+                max_sentences_length_placeholder: max_sentences_length_in_batch,
+                dropout_prob_placeholder: 1.0
+                }
+
+    def evaluate_dev():
+        metrics = reset_tagging_metrics()
+        dev_batches = predict_in_batches(sess, viterbi_sequence, get_dev_feed_dict, dev_sents, dev_labels, dev_sequence_lengths, \
+                                        map_word_id[''], labels_template.index('PAD'), batch_size=eval_batch_size, offsets=dev_offsets)
+        for sent_batch, label_batch, sequence_length_batch, predicts in dev_batches:
+            update_tagging_metrics(metrics, label_batch, sequence_length_batch, predicts)
+        _, _, F1, _ = chunk_scores(metrics['labels'], metrics['predicts'], metrics['lengths'])
+        return F1
+
+    # best dev F1 so far, kept next to the best checkpoint so a resumed run goes on with it
+    best_saver = tf.train.Saver(max_to_keep=1)
+    best_state = {'step': None, 'F1': -1.0, 'evals_without_improvement': 0, 'evaluated_step': None}
+    if latest_checkpoint is not None and os.path.isfile(os.path.join(best_folder, 'best.json')):
+        with open(os.path.join(best_folder, 'best.json')) as f:
+            best_state = json.load(f)
+
+    def update_best():
+        F1 = evaluate_dev()
+        if not os.path.isdir(best_folder):
+            os.makedirs(best_folder)
+        if F1 > best_state['F1']:
+            best_state.update({'step': int(step), 'F1': F1, 'evals_without_improvement': 0})
+            best_saver.save(sess, os.path.join(best_folder, 'ckpt'))
+        else:
+            best_state['evals_without_improvement'] += 1
+        best_state['evaluated_step'] = int(step)
+        with open(os.path.join(best_folder, 'best.json'), 'w') as f:
+            json.dump(best_state, f)
+        print('dev F1 %.2f%% (best %.2f%% at step %d)' % (100*F1, 100*best_state['F1'], best_state['step']))
+
+    timer = time()
+    checkpoint_timer = time()
+    first_step = step
+    train_metrics = reset_tagging_metrics()
+    for feed_dict in feed_dicts:
+        try:
+            # the CRF decode is only run on the sampled steps, the labels and lengths are fetched for the dataset mode
+            if train_metrics_every_steps is not None and step % train_metrics_every_steps == 0:
+                loss_, _, predicts, label_batch, sequence_length_batch = sess.run([train_loss, train_op, viterbi_sequence, labels_placeholder, sequence_lengths_placeholder], feed_dict=feed_dict)
+                update_tagging_metrics(train_metrics, label_batch, sequence_length_batch, predicts)
+            else:
+                loss_, _ = sess.run([train_loss, train_op], feed_dict=feed_dict)
+        except tf.errors.OutOfRangeError:
+            break
         step += 1
+        # the first step (graph setup, memory allocation) is left out of the throughput
+        if step == first_step + 1:
+            train_timer = time()
+        if max_steps is not None:
+            if step - first_step >= max_steps:
+                break
+            continue
+        if (checkpoint_every_steps is not None and step % checkpoint_every_steps == 0) or \
+                (checkpoint_every_minutes is not None and time() - checkpoint_timer > 60*checkpoint_every_minutes):
+            save_checkpoint()
+            checkpoint_timer = time()
         if step % n_batches == 0 or step >= n_batches*n_epochs - 1:
             print("Step %d/%d Loss: %f" % (step, n_batches*n_epochs, loss_), end=' ')
             print('Took %fs' % (time() - timer), end=' ')
-            print('avg each step %fs' % ((time() - timer)/n_batches))
+            print('avg each step %fs' % ((time() - timer)/n_batches), end=' ')
+            print('lr %g' % sess.run(scheduled_learning_rate), end=' ')
+            if 'padding_ratio' in padding_stats:
+                print('padding %.2f%%' % (100*padding_stats['padding_ratio']), end=' ')
+            if train_metrics['tokens'] > 0:
+                _, _, train_f1, _ = chunk_scores(train_metrics['labels'], train_metrics['predicts'], train_metrics['lengths'])
+                print('sampled train acc %.2f%% F1 %.2f%% (%d sentences)' % (100.0*train_metrics['correct']/train_metrics['tokens'], 100*train_f1, len(train_metrics['lengths'])), end=' ')
+                train_metrics = reset_tagging_metrics()
+            print()
+            if eval_every_epochs is not None and step % (eval_every_epochs*n_batches) == 0:
+                update_best()
+                if early_stopping_patience is not None and best_state['evals_without_improvement'] >= early_stopping_patience:
+                    print("Early stopping: no dev F1 improvement in %d evaluations" % early_stopping_patience)
+                    break
             timer = time()
-        break
 
     print()
+    if step - first_step > 1:
+        print("Trained %d steps in %fs, %f sentences/s" % (step - first_step - 1, time() - train_timer, (step - first_step - 1)*batch_size/(time() - train_timer)))
+    if max_steps is not None:
+        sys.exit(0)
+
+    # the saved and exported model is the best one on the dev split
+    if eval_every_epochs is not None:
+        # the last weights are only scored if no evaluation ran on them (end of a non-evaluated epoch)
+        if best_state.get('evaluated_step') != step:
+            update_best()
+        best_saver.restore(sess, tf.train.latest_checkpoint(best_folder))
+        print("Best dev F1 %.2f%% at step %d" % (100*best_state['F1'], best_state['step']))
 
     saver = tf.train.Saver()
 
-    saved_model_folder = '../saved_model/'
     if os.path.isdir(saved_model_folder) == False:
         os.mkdir(saved_model_folder)
 
-    if os.path.isdir(os.path.join(saved_model_folder, '%s-%s' % (type_embeddings, tagging))) == False:
-        os.mkdir(os.path.join(saved_model_folder, '%s-%s' % (type_embeddings, tagging)))
-
-    saver.save(sess, os.path.join(saved_model_folder, '%s-%s' % (type_embeddings, tagging), 'ckpt'))
+    if os.path.isdir(model_folder) == False:
+        os.mkdir(model_folder)
+
+    saver.save(sess, os.path.join(model_folder, 'ckpt'))
+    # frozen decoding-only graph fed with the word vectors, loaded by predict.py
+    export_inference_graph(sess, os.path.join(model_folder, 'inference'), \
+                            inputs={'characters': chars_placeholder,
+                                    'lengths': sequence_lengths_placeholder,
+                                    'max_sentences_length_in_batch': max_sentences_length_placeholder,
+                                    'vectors': vectors},
+                            outputs={'viterbi_sequence': viterbi_sequence,
+                                     'logits': logits,
+                                     'trans_params': trans_params})
     
     print("Training: Done")
     
@@ -175,34 +422,14 @@ with tf.Session(config = config) as sess:
     print("\n\n\n")
     
     print('Developing: Start')
-    if os.path.isdir('eval_dev'):
-        os.mkdir('eval_dev')
+    if not os.path.isdir('../eval_dev'):
+        os.mkdir('../eval_dev')
+
     tsvfile = open('../eval_dev/predict_file_%s_%s.tsv' % (type_embeddings, tagging), 'w')
-    for idx in range(dev_sents.shape[0]):
-        sent = dev_sents[idx].reshape(1, -1)
-        label = dev_labels[idx].reshape(1, -1)
-        sequence_length = np.array([dev_sequence_lengths[idx]])
-
-        # print(sequence_length)
-        max_sentences_length_in_batch = sent.shape[1]
-
-        chars_indices = word_indices_to_char_indices(sent, sequence_length, max_sentences_length_in_batch, max_word_len, char_dict, map_id_word)
-        predict = sess.run(viterbi_sequence, feed_dict={sentences_placeholder: sent,
-                                                        labels_placeholder: label,
-                                                        sequence_lengths_placeholder: sequence_length,
-                                                        chars_placeholder: chars_indices,
-                                                        max_sentences_length_placeholder: max_sentences_length_in_batch,
-                                                        dropout_prob_placeholder: 1.0
-                                                        })
-
-        sent = sent[0]
-        label = label[0]
-        if sequence_length[0] > 0:
-            for subidx in range(sequence_length[0]):        
-                word = get_word_from_idx(map_id_word, sent[subidx])
-                golden_tag = labels_template[label[subidx]]
-                predict_tag = labels_template[predict[0][subidx]]
-                tsvfile.write("%s\t%s\t%s\n" % (word, golden_tag, predict_tag))
-            tsvfile.write('-\tX\t-\n')
-        
+    dev_batches = predict_in_batches(sess, viterbi_sequence, get_dev_feed_dict, dev_sents, dev_labels, dev_sequence_lengths, \
+                                    map_word_id[''], labels_template.index('PAD'), batch_size=eval_batch_size, offsets=dev_offsets)
+    for sent_batch, label_batch, sequence_length_batch, predicts in dev_batches:
+        write_predictions(tsvfile, sent_batch, label_batch, sequence_length_batch, predicts, map_id_word, labels_template)
+    tsvfile.close()
+
     print("Developing: Done")
\ No newline at end of file
@@ -1,16 +1,15 @@
 import re
 import os
 import numpy as np
-import tensorflow as tf
 def readFileTSV(filename='../eval_dev/predict_file.tsv'):
     sentences = [[]]
     labels = [[]]
     predicts = [[]]
-    
-   
+
+
     with open(filename) as f:
-        for _, line in enumerate(f.readlines()):
-            row = re.split("\t", line)
+        for line in f:
+            row = line.split("\t")
             if row[1] == 'X' :
                 sentences.append([])
                 labels.append([])
@@ -26,51 +25,160 @@ def readFileTSV(filename='../eval_dev/predict_file.tsv'):
     return sentences, labels, predicts
 
 
+def encode_tags(labels, predicts, lengths):
+    """
+    Flattens the first lengths[i] tags of every sentence into int arrays.
+    Returns gold ids, predicted ids, the tags (gold tags first, in order of appearance)
+    and a boolean array marking the first token of every sentence.
+    """
+    gold_tags = []
+    predict_tags = []
+    for idx_sent in range(len(lengths)):
+        gold_tags.extend(labels[idx_sent][:lengths[idx_sent]])
+        predict_tags.extend(predicts[idx_sent][:lengths[idx_sent]])
+
+    tag_ids = dict.fromkeys(gold_tags)
+    tag_ids.update(dict.fromkeys(predict_tags))
+    tags = list(tag_ids)
+    for idx, tag in enumerate(tags):
+        tag_ids[tag] = idx
+    gold = np.fromiter(map(tag_ids.__getitem__, gold_tags), dtype=np.int64, count=len(gold_tags))
+    predict = np.fromiter(map(tag_ids.__getitem__, predict_tags), dtype=np.int64, count=len(predict_tags))
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    sentence_starts = np.zeros(shape=[gold.shape[0]], dtype=bool)
+    sentence_starts[(np.cumsum(lengths) - lengths)[lengths > 0]] = True
+    return gold, predict, tags, sentence_starts
+
+def confusion_matrix(gold, predict, n_tags):
+    """
+    [n_tags, n_tags] matrix, rows are gold tags and columns predicted tags.
+    """
+    return np.bincount(gold*n_tags + predict, minlength=n_tags*n_tags).reshape(n_tags, n_tags)
+
+def _precision_recall_f1(tp, fp, fn):
+    precision = tp / np.maximum(tp + fp, 1)
+    recall = tp / np.maximum(tp + fn, 1)
+    F1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+    return precision, recall, F1
 
 def my_eval(sentences, labels, predicts, lengths):
-    def get_labels_template(labels):
-        labels_template = []
-        for label in labels:
-            for sublabel in label:
-                if sublabel not in labels_template:
-                    labels_template.append(sublabel)
-        return labels_template
     TRUE_POSITIVE = 0
     FALSE_POSITIVE = 1
     TRUE_NEGATIVE = 2
     FALSE_NEGATIVE = 3
 
-    labels_template = get_labels_template(labels)
-    eval_matrix = np.zeros(shape=[len(labels_template), 4], dtype=np.int32)
-    for idx_label_template, label_template in enumerate(labels_template):
-
-        for idx_sent in range(len(lengths)):
-            label = labels[idx_sent]
-            predict = predicts[idx_sent]
-            for idx_word in range(lengths[idx_sent]):
-                ground_truth = label[idx_word]
-                predict_tag = predict[idx_word]
-                colx = 0
-                if ground_truth == label_template: #positive
-                    colx = 0
-                else: #negative
-                    colx = 2
-                if ground_truth == predict_tag: #true
-                    colx += 0
-                else: #false
-                    colx += 1
-                eval_matrix[idx_label_template, colx] += 1
-    TP = eval_matrix[:,TRUE_POSITIVE].sum()
-    FP = eval_matrix[:,FALSE_POSITIVE].sum()
-    FN = eval_matrix[:,FALSE_NEGATIVE].sum()
+    gold, predict, tags, _ = encode_tags(labels, predicts, lengths)
+    n_labels = len(set(tag for label in labels for tag in label))
+    n_correct = int((gold == predict).sum())
+    n_wrong = gold.shape[0] - n_correct
+
+    # every token is a positive for its gold tag and a negative for the n_labels - 1 others
+    eval_matrix = np.zeros(shape=[4], dtype=np.int64)
+    eval_matrix[TRUE_POSITIVE] = n_correct
+    eval_matrix[FALSE_POSITIVE] = n_wrong
+    eval_matrix[TRUE_NEGATIVE] = (n_labels - 1) * n_correct
+    eval_matrix[FALSE_NEGATIVE] = (n_labels - 1) * n_wrong
+    TP = eval_matrix[TRUE_POSITIVE]
+    FP = eval_matrix[FALSE_POSITIVE]
+    FN = eval_matrix[FALSE_NEGATIVE]
     precision = float(TP) / (TP + FP)
     recall = float(TP) / (TP + FN)
     F1 = 2 * precision * recall / (precision + recall)
-    
+
     return precision, recall, F1
+
+def token_scores(labels, predicts, lengths):
+    """
+    Per-tag token-level scores, returns a dict tag -> (TP, FP, FN, precision, recall, F1).
+    """
+    gold, predict, tags, _ = encode_tags(labels, predicts, lengths)
+    matrix = confusion_matrix(gold, predict, len(tags))
+    tp = np.diag(matrix)
+    fp = matrix.sum(axis=0) - tp
+    fn = matrix.sum(axis=1) - tp
+    precision, recall, F1 = _precision_recall_f1(tp, fp, fn)
+    return {tag: (tp[idx], fp[idx], fn[idx], precision[idx], recall[idx], F1[idx]) for idx, tag in enumerate(tags)}
+
+OUTSIDE, BEGIN, INSIDE, END, SINGLE = range(5)
+PREFIXES = {'B': BEGIN, 'I': INSIDE, 'E': END, 'S': SINGLE}
+
+def _parse_tags(tags):
+    # prefix and entity type id of every tag, 'O', 'PAD' and unknown prefixes are outside
+    prefixes = np.full(shape=[len(tags)], fill_value=OUTSIDE, dtype=np.int64)
+    types = np.full(shape=[len(tags)], fill_value=-1, dtype=np.int64)
+    entity_types = []
+    for idx, tag in enumerate(tags):
+        split = tag.split('-', 1)
+        if len(split) == 2 and split[0] in PREFIXES:
+            if split[1] not in entity_types:
+                entity_types.append(split[1])
+            prefixes[idx] = PREFIXES[split[0]]
+            types[idx] = entity_types.index(split[1])
+    return prefixes, types, entity_types
+
+def get_chunks(tag_ids, sentence_starts, prefixes, types):
+    """
+    Chunks of a flat tag id sequence in the BIO or BIOES scheme, with the conlleval rules
+    for ill-formed sequences (e.g. an I-X after O starts a chunk).
+    Returns the start and end token positions and the entity type id of every chunk.
+    """
+    prefix = prefixes[tag_ids]
+    type_ = types[tag_ids]
+    sentence_ends = np.roll(sentence_starts, -1)
+    if sentence_ends.shape[0] > 0:
+        sentence_ends[-1] = True
+
+    prev_prefix = np.where(sentence_starts, OUTSIDE, np.roll(prefix, 1))
+    prev_type = np.where(sentence_starts, -1, np.roll(type_, 1))
+    next_prefix = np.where(sentence_ends, OUTSIDE, np.roll(prefix, -1))
+    next_type = np.where(sentence_ends, -1, np.roll(type_, -1))
+
+    inside = prefix != OUTSIDE
+    is_start = inside & (np.isin(prefix, [BEGIN, SINGLE]) | np.isin(prev_prefix, [OUTSIDE, END, SINGLE]) | (prev_type != type_))
+    is_end = inside & (np.isin(prefix, [END, SINGLE]) | np.isin(next_prefix, [OUTSIDE, BEGIN, SINGLE]) | (next_type != type_))
+    starts = np.flatnonzero(is_start)
+    ends = np.flatnonzero(is_end)
+    return starts, ends, type_[starts]
+
+def chunk_scores(labels, predicts, lengths):
+    """
+    Entity-level (chunk) scores for BIO and BIOES tags, a chunk is correct when its
+    boundaries and type match a gold chunk.
+    Returns precision, recall, F1 and a dict entity type -> (precision, recall, F1).
+    """
+    gold, predict, tags, sentence_starts = encode_tags(labels, predicts, lengths)
+    prefixes, types, entity_types = _parse_tags(tags)
+    n_tokens = gold.shape[0]
+    n_types = max(len(entity_types), 1)
+
+    def chunk_keys(tag_ids):
+        starts, ends, chunk_types = get_chunks(tag_ids, sentence_starts, prefixes, types)
+        return (starts*(n_tokens + 1) + ends)*n_types + chunk_types
+
+    gold_keys = chunk_keys(gold)
+    predict_keys = chunk_keys(predict)
+    correct_keys = np.intersect1d(gold_keys, predict_keys, assume_unique=True)
+
+    tp = np.bincount(correct_keys % n_types, minlength=n_types)
+    n_gold = np.bincount(gold_keys % n_types, minlength=n_types)
+    n_predict = np.bincount(predict_keys % n_types, minlength=n_types)
+    precision, recall, F1 = _precision_recall_f1(tp, n_predict - tp, n_gold - tp)
+    per_type = {entity_type: (precision[idx], recall[idx], F1[idx]) for idx, entity_type in enumerate(entity_types)}
+
+    precision, recall, F1 = _precision_recall_f1(tp.sum(), n_predict.sum() - tp.sum(), n_gold.sum() - tp.sum())
+    return float(precision), float(recall), float(F1), per_type
+
 if __name__ == '__main__':
     sentences, labels, predicts = readFileTSV()
-    precision, recall, F1 = eval(sentences, labels, predicts)
+    lengths = [len(sent) for sent in sentences]
+    precision, recall, F1 = my_eval(sentences, labels, predicts, lengths)
     print("Precision: ", precision)
     print("Recall: ", recall)
-    print("F1: ", F1)
\ No newline at end of file
+    print("F1: ", F1)
+    precision, recall, F1, per_type = chunk_scores(labels, predicts, lengths)
+    print("Entity precision: ", precision)
+    print("Entity recall: ", recall)
+    print("Entity F1: ", F1)
+    for entity_type in per_type:
+        print("%s\t%f\t%f\t%f" % ((entity_type,) + per_type[entity_type]))
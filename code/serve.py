@@ -0,0 +1,245 @@
+"""
+Long-lived tagging server: loads ../saved_model/<emb>-<tag>/ once and serves it over HTTP on localhost.
+
+    python serve.py <type_embeddings> <tagging> [port]
+
+POST /tag   {"sentences": [["token", ...], ...]}  ->  {"tags": [["B-X", ...], ...]}
+GET  /stats throughput and latency counters
+
+Concurrent requests are grouped into micro-batches of up to max_batch_size sentences, a batch
+is decoded when it is full or when its oldest request has waited max_latency_ms.
+"""
+import sys
+import json
+import queue
+import threading
+import urllib.request
+from time import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tensorflow as tf
+from Task1_datahelper import get_allowed_transitions, load_data_feed, build_char_index_matrix, update_lookup_table_for_testing, get_batched_feed_dict_for_testing, AppendOnlyTable, \
+                             load_pretrained_embeddings, load_ngram_vectors
+from Task1_tfhelper import load_tagging_model, TESTING_FEED_KEYS
+from viterbi import viterbi_decode
+
+max_batch_size = 64
+max_latency_ms = 10
+oov_backend = 'ngram'
+decoder = 'graph' # or 'numpy', see predict.py
+constrained_decoding = False
+
+
+class TaggingRequest(object):
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.tags = None
+        self.error = None
+        self.received = time()
+        self.done = threading.Event()
+
+
+class MicroBatchTagger(object):
+    """
+    Owns the session and the vocabulary: a single worker thread takes the queued requests,
+    extends the lookup table with their OOV words and decodes them in micro-batches.
+    The OOV words of a micro-batch are dropped once it is decoded, so the vocabulary
+    stays the trained one however many distinct tokens the server sees.
+    """
+    def __init__(self, type_embeddings, tagging, config=None):
+        data = load_data_feed("../data_feed_model/%s_%s" % (type_embeddings, tagging))
+        self.type_embeddings = type_embeddings
+        self.labels_template = data['labels_template']
+        self.map_word_id = data['map_word_id']
+        self.map_id_word = data['map_id_word']
+        self.char_dict = data['char_dict']
+        self.max_word_len = data['max_word_len']
+        self.lookup_table = AppendOnlyTable(data['lookup_table'])
+        self.char_index_matrix = build_char_index_matrix(self.map_id_word, self.max_word_len, self.char_dict)
+        self.n_vocabs = len(self.map_word_id)
+        # the OOV vectors come from these, load (and build on first use) before serving
+        if type_embeddings != 'random':
+            load_pretrained_embeddings(type_embeddings)
+            if oov_backend == 'ngram':
+                load_ngram_vectors(type_embeddings)
+        self.sess, self.inputs, self.outputs = load_tagging_model('../saved_model/%s-%s/' % (type_embeddings, tagging), config)
+        if decoder == 'numpy':
+            self.trans_params = self.sess.run(self.outputs['trans_params'])
+            self.constraints = get_allowed_transitions(self.labels_template, tagging) if constrained_decoding else None
+
+        self.requests = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.started = time()
+        self.counters = {'requests': 0, 'sentences': 0, 'tokens': 0, 'batches': 0, 'errors': 0}
+        self.latencies = deque(maxlen=10000)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def tag(self, sentences):
+        request = TaggingRequest(sentences)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.tags
+
+    def stats(self):
+        with self.stats_lock:
+            res = dict(self.counters)
+            latencies = sorted(self.latencies)
+        elapsed = time() - self.started
+        res['uptime_s'] = elapsed
+        res['sentences_per_s'] = res['sentences'] / elapsed
+        res['tokens_per_s'] = res['tokens'] / elapsed
+        res['mean_batch_size'] = float(res['sentences']) / max(res['batches'], 1)
+        for name, q in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99)]:
+            res['latency_%s_ms' % name] = 1000*latencies[int(q*(len(latencies) - 1))] if latencies else None
+        return res
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        n_sentences = len(batch[0].sentences)
+        deadline = batch[0].received + max_latency_ms/1000.0
+        while n_sentences < max_batch_size:
+            # requests queued while the previous batch was decoded join without waiting,
+            # the deadline only bounds the wait for new ones
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            batch.append(request)
+            n_sentences += len(request.sentences)
+        return batch
+
+    def _decode(self, sentences):
+        sentences = [[word.lower().strip() for word in sent] for sent in sentences]
+        try:
+            update_lookup_table_for_testing(sentences, self.lookup_table, self.map_id_word, self.map_word_id, self.type_embeddings, \
+                                            self.char_index_matrix, oov_backend=oov_backend)
+            return self._decode_known(sentences)
+        finally:
+            self._forget_oov_words()
+
+    def _forget_oov_words(self):
+        for id_ in range(self.n_vocabs, len(self.map_id_word)):
+            del self.map_word_id[self.map_id_word.pop(id_)]
+        self.lookup_table.truncate(self.n_vocabs)
+        self.char_index_matrix.truncate(self.n_vocabs)
+
+    def _decode_known(self, sentences):
+        corpus = [(sent, ['PAD']*len(sent), len(sent)) for sent in sentences if len(sent) > 0]
+        predicts = []
+        feed_dicts = get_batched_feed_dict_for_testing(corpus, self.max_word_len, self.char_dict, self.labels_template, self.lookup_table.table, \
+                                                        self.map_id_word, self.map_word_id, batch_size=max_batch_size, char_index_matrix=self.char_index_matrix)
+        for batch, fd in feed_dicts:
+            feed_dict = {tensor: fd[TESTING_FEED_KEYS[name]] for name, tensor in self.inputs.items()}
+            if decoder == 'numpy':
+                batch_predicts, _ = viterbi_decode(self.sess.run(self.outputs['logits'], feed_dict=feed_dict), self.trans_params, \
+                                                   fd['sequence_lengths_placeholder'], self.constraints)
+            else:
+                batch_predicts = self.sess.run(self.outputs['viterbi_sequence'], feed_dict=feed_dict)
+            for (_, _, sequence_length), predict in zip(batch, batch_predicts):
+                predicts.append([self.labels_template[tag] for tag in predict[:sequence_length]])
+        predicts = iter(predicts)
+        return [next(predicts) if len(sent) > 0 else [] for sent in sentences]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                tags = self._decode([sent for request in batch for sent in request.sentences])
+                offset = 0
+                for request in batch:
+                    request.tags = tags[offset:offset + len(request.sentences)]
+                    offset += len(request.sentences)
+            except Exception:
+                # decode the requests one by one so only the failing ones get the error
+                for request in batch:
+                    try:
+                        request.tags = self._decode(request.sentences)
+                    except Exception as e:
+                        request.error = e
+
+            finished = time()
+            with self.stats_lock:
+                self.counters['batches'] += 1
+                for request in batch:
+                    self.counters['requests'] += 1
+                    if request.error is None:
+                        self.counters['sentences'] += len(request.sentences)
+                        self.counters['tokens'] += sum(len(sent) for sent in request.sentences)
+                    else:
+                        self.counters['errors'] += 1
+                    self.latencies.append(finished - request.received)
+            for request in batch:
+                request.done.set()
+
+
+def make_handler(tagger):
+    class TaggingHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, tagger.stats())
+            else:
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/tag':
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                sentences = request['sentences']
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': 'bad request: %s' % e})
+                return
+            # checked here, a malformed request would otherwise fail its whole micro-batch
+            if not isinstance(sentences, list) or not all(isinstance(sent, list) and all(isinstance(word, str) for word in sent) for sent in sentences):
+                self._reply(400, {'error': 'bad request: sentences must be a list of lists of tokens'})
+                return
+            try:
+                self._reply(200, {'tags': tagger.tag(sentences)})
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return TaggingHandler
+
+def tag(sentences, host='127.0.0.1', port=8500):
+    """
+    Client helper: tags tokenized sentences with a running server.
+    """
+    request = urllib.request.Request('http://%s:%d/tag' % (host, port), data=json.dumps({'sentences': sentences}).encode('utf-8'), \
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))['tags']
+
+def serve(type_embeddings, tagging, host='127.0.0.1', port=8500):
+    tagger = MicroBatchTagger(type_embeddings, tagging, config=tf.ConfigProto(allow_soft_placement=True))
+    server = ThreadingHTTPServer((host, port), make_handler(tagger))
+    print("Serving %s-%s on http://%s:%d" % (type_embeddings, tagging, host, port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    type_embeddings = sys.argv[1].strip()
+    tagging = sys.argv[2].strip()
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8500
+    serve(type_embeddings, tagging, port=port)
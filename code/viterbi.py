@@ -0,0 +1,180 @@
+"""
+CRF decoding in NumPy, from the emission logits and the trans_params exported with the
+inference graph, so tagging can run outside TensorFlow.
+
+    python viterbi.py <type_embeddings> <tagging> [n_best]
+
+checks viterbi_decode against the in-graph crf_decode on the dev set and times both.
+"""
+import sys
+import numpy as np
+from time import time
+
+# added to the scores of illegal transitions, large enough to never be chosen while keeping the scores finite
+TRANSITION_PENALTY = -10000.0
+
+def constrain_scores(logits, trans_params, sequence_lengths, constraints):
+    """
+    Applies constraints = (allowed, allowed_start, allowed_end), see get_allowed_transitions:
+    TRANSITION_PENALTY is added to the illegal transitions and to the logits of the tags
+    illegal at the first and the last position of every sentence.
+    Returns the constrained logits and trans_params.
+    """
+    allowed, allowed_start, allowed_end = constraints
+    lengths = np.asarray(sequence_lengths, dtype=np.int64)
+    trans_params = np.where(allowed, trans_params, trans_params + TRANSITION_PENALTY).astype(np.float32)
+    logits = np.array(logits, dtype=np.float32)
+    batch_idx = np.flatnonzero(lengths > 0)
+    logits[batch_idx, 0] += np.where(allowed_start, 0.0, TRANSITION_PENALTY).astype(np.float32)
+    logits[batch_idx, lengths[batch_idx] - 1] += np.where(allowed_end, 0.0, TRANSITION_PENALTY).astype(np.float32)
+    return logits, trans_params
+
+
+def viterbi_decode(logits, trans_params, sequence_lengths, constraints=None):
+    """
+    Batched Viterbi, same results as tf.contrib.crf.crf_decode.
+    logits: [batch_size, max_seq_len, num_tags], trans_params: [num_tags, num_tags],
+    sequence_lengths: [batch_size], constraints: see constrain_scores.
+    Returns the best tag sequences [batch_size, max_seq_len] (0 after sequence_lengths[i])
+    and their scores [batch_size].
+    """
+    if constraints is not None:
+        logits, trans_params = constrain_scores(logits, trans_params, sequence_lengths, constraints)
+    logits = np.asarray(logits, dtype=np.float32)
+    trans_params = np.asarray(trans_params, dtype=np.float32)
+    lengths = np.asarray(sequence_lengths, dtype=np.int64)
+    batch_size, max_seq_len, num_tags = logits.shape
+
+    tags = np.zeros(shape=[batch_size, max_seq_len], dtype=np.int32)
+    if max_seq_len == 0:
+        return tags, np.zeros(shape=[batch_size], dtype=np.float32)
+
+    # past the end of a sentence the scores are carried over and the backpointers are the identity,
+    # so backtracking from the last position reaches the best last tag of every sentence
+    identity = np.arange(num_tags, dtype=np.int32)
+    backpointers = np.empty(shape=[max_seq_len, batch_size, num_tags], dtype=np.int32)
+    score = logits[:, 0]
+    for t in range(1, max_seq_len):
+        candidates = score[:, :, None] + trans_params[None]
+        best_previous = candidates.argmax(axis=1).astype(np.int32)
+        new_score = np.take_along_axis(candidates, best_previous[:, None], axis=1)[:, 0] + logits[:, t]
+        active = (t < lengths)[:, None]
+        score = np.where(active, new_score, score)
+        backpointers[t] = np.where(active, best_previous, identity)
+
+    batch_idx = np.arange(batch_size)
+    tag = score.argmax(axis=1).astype(np.int32)
+    best_score = score[batch_idx, tag]
+    tags[:, -1] = tag
+    for t in range(max_seq_len - 1, 0, -1):
+        tag = backpointers[t, batch_idx, tag]
+        tags[:, t - 1] = tag
+    tags[np.arange(max_seq_len)[None] >= lengths[:, None]] = 0
+    return tags, best_score
+
+def viterbi_nbest(logits, trans_params, sequence_lengths, n_best=5, constraints=None):
+    """
+    Batched n-best Viterbi: the n_best highest scoring tag sequences of every sentence.
+    Returns tags [batch_size, n_best, max_seq_len] (0 after sequence_lengths[i]) and
+    scores [batch_size, n_best], best first. When a sentence has fewer than n_best possible
+    sequences, the remaining scores are -inf.
+    """
+    if constraints is not None:
+        logits, trans_params = constrain_scores(logits, trans_params, sequence_lengths, constraints)
+    logits = np.asarray(logits, dtype=np.float32)
+    trans_params = np.asarray(trans_params, dtype=np.float32)
+    lengths = np.asarray(sequence_lengths, dtype=np.int64)
+    batch_size, max_seq_len, num_tags = logits.shape
+
+    tags = np.zeros(shape=[batch_size, n_best, max_seq_len], dtype=np.int32)
+    if max_seq_len == 0:
+        return tags, np.zeros(shape=[batch_size, n_best], dtype=np.float32)
+
+    # score[b, k, j]: k-th best score of a prefix ending with tag j, backpointers hold k*num_tags + i
+    # of the previous (rank, tag)
+    identity = np.arange(n_best*num_tags, dtype=np.int32).reshape(n_best, num_tags)
+    backpointers = np.empty(shape=[max_seq_len, batch_size, n_best, num_tags], dtype=np.int32)
+    score = np.full(shape=[batch_size, n_best, num_tags], fill_value=-np.inf, dtype=np.float32)
+    score[:, 0] = logits[:, 0]
+    for t in range(1, max_seq_len):
+        candidates = (score[:, :, :, None] + trans_params[None, None]).reshape(batch_size, n_best*num_tags, num_tags)
+        best_previous = np.argsort(-candidates, axis=1, kind='stable')[:, :n_best].astype(np.int32)
+        new_score = np.take_along_axis(candidates, best_previous, axis=1) + logits[:, t, None]
+        active = (t < lengths)[:, None, None]
+        score = np.where(active, new_score, score)
+        backpointers[t] = np.where(active, best_previous, identity)
+
+    batch_idx = np.arange(batch_size)[:, None]
+    score = score.reshape(batch_size, n_best*num_tags)
+    state = np.argsort(-score, axis=1, kind='stable')[:, :n_best].astype(np.int32)
+    best_scores = np.take_along_axis(score, state, axis=1)
+    tags[:, :, -1] = state % num_tags
+    for t in range(max_seq_len - 1, 0, -1):
+        state = backpointers[t, batch_idx, state // num_tags, state % num_tags]
+        tags[:, :, t - 1] = state % num_tags
+    tags *= (np.arange(max_seq_len)[None] < lengths[:, None])[:, None]
+    return tags, best_scores
+
+
+if __name__ == '__main__':
+    import tensorflow as tf
+    from Task1_datahelper import load_data_feed, build_char_index_matrix, get_batched_feed_dict_for_testing
+    from Task1_tfhelper import load_tagging_model, TESTING_FEED_KEYS
+
+    type_embeddings = sys.argv[1].strip()
+    tagging = sys.argv[2].strip()
+    n_best = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    batch_size = 64
+
+    data = load_data_feed("../data_feed_model/%s_%s" % (type_embeddings, tagging))
+    labels_template = data['labels_template']
+    map_word_id = data['map_word_id']
+    map_id_word = data['map_id_word']
+    char_index_matrix = build_char_index_matrix(map_id_word, data['max_word_len'], data['char_dict'])
+    dev_sentences = data['dev_sentences_buffer']
+    dev_labels = data['dev_labels_buffer']
+    dev_offsets = data['dev_offsets']
+    dev_corpus = [([map_id_word[idx] for idx in dev_sentences[start:end]], [labels_template[idx] for idx in dev_labels[start:end]], end - start) \
+                    for start, end in zip(dev_offsets[:-1], dev_offsets[1:])]
+
+    sess, inputs, outputs = load_tagging_model('../saved_model/%s-%s/' % (type_embeddings, tagging), tf.ConfigProto(allow_soft_placement=True))
+    with sess:
+        trans_params = sess.run(outputs['trans_params'])
+        feed_dicts = list(get_batched_feed_dict_for_testing(dev_corpus, data['max_word_len'], data['char_dict'], labels_template, data['lookup_table'], \
+                                                            map_id_word, map_word_id, batch_size=batch_size, char_index_matrix=char_index_matrix))
+        feed_dicts = [(batch, {tensor: fd[TESTING_FEED_KEYS[name]] for name, tensor in inputs.items()}, fd[TESTING_FEED_KEYS['lengths']]) \
+                        for batch, fd in feed_dicts]
+
+        graph_time = logits_time = numpy_time = nbest_time = 0.0
+        n_tokens = n_mismatches = n_sentences_mismatches = n_nbest_mismatches = 0
+        for batch, feed_dict, sequence_lengths in feed_dicts:
+            timer = time()
+            graph_predicts = sess.run(outputs['viterbi_sequence'], feed_dict=feed_dict)
+            graph_time += time() - timer
+
+            timer = time()
+            logits = sess.run(outputs['logits'], feed_dict=feed_dict)
+            logits_time += time() - timer
+
+            timer = time()
+            predicts, _ = viterbi_decode(logits, trans_params, sequence_lengths)
+            numpy_time += time() - timer
+
+            timer = time()
+            nbest_predicts, _ = viterbi_nbest(logits, trans_params, sequence_lengths, n_best)
+            nbest_time += time() - timer
+
+            mask = np.arange(predicts.shape[1])[None] < sequence_lengths[:, None]
+            mismatches = (predicts != graph_predicts) & mask
+            n_tokens += int(mask.sum())
+            n_mismatches += int(mismatches.sum())
+            n_sentences_mismatches += int(mismatches.any(axis=1).sum())
+            n_nbest_mismatches += int(((nbest_predicts[:, 0] != predicts) & mask).sum())
+
+    print("Sentences: %d Tokens: %d" % (len(dev_corpus), n_tokens))
+    print("Tokens differing from crf_decode: %d (%d sentences)" % (n_mismatches, n_sentences_mismatches))
+    print("Tokens of the 1st of %d-best differing from viterbi_decode: %d" % (n_best, n_nbest_mismatches))
+    print("In-graph logits + crf_decode: %fs" % graph_time)
+    print("In-graph logits: %fs + viterbi_decode: %fs = %fs" % (logits_time, numpy_time, logits_time + numpy_time))
+    print("viterbi_nbest (n_best=%d): %fs" % (n_best, nbest_time))
+    print("viterbi_decode: %f tokens/s" % (n_tokens / max(numpy_time, 1e-12)))
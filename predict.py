@@ -3,7 +3,9 @@ import shelve
 import numpy as np
 import tensorflow as tf
 from time import time
-from Task1_datahelper import load_from_file, word_2_indices_per_char, decode_labels, batch_iter, get_word_from_idx, word_indices_to_char_indices, next_lr, get_feed_dict_for_testting, readFileTSV, update_lookup_table_for_testing
+from Task1_datahelper import get_allowed_transitions, load_data_feed, word_2_indices_per_char, decode_labels, batch_iter, get_word_from_idx, word_indices_to_char_indices, next_lr, get_feed_dict_for_testting, readFileTSV, update_lookup_table_for_testing, build_char_index_matrix, iter_corpus_tsv, get_batched_feed_dict_for_testing, LOOKUP_TABLE_SEED
+from Task1_tfhelper import load_tagging_model, TESTING_FEED_KEYS
+from viterbi import viterbi_decode
 from math import sqrt
 import sys
 
@@ -14,7 +16,7 @@ print()
 print("Type embeddings: %s " % type_embeddings)
 print("Tagging: %s" % tagging)
 
-data = load_from_file("../data_feed_model/%s_%s.shlv" % (type_embeddings, tagging))
+data = load_data_feed("../data_feed_model/%s_%s" % (type_embeddings, tagging))
 
 labels_template = data['labels_template']
 lookup_table = data['lookup_table']
@@ -23,57 +25,46 @@ map_id_word = data['map_id_word']
 char_dict = data['char_dict']
 max_word_len = data['max_word_len']
 
-test_sentences, test_labels, test_sequence_lengths = readFileTSV('../test_tsv')
+test_dirname = '../test_tsv'
+predict_batch_size = 64
+oov_backend = 'ngram' # vectors of OOV test words, 'ngram' or 'random'
+decoder = 'graph' # 'graph' for crf_decode in the session, 'numpy' to only fetch the logits and decode with viterbi_decode
+constrained_decoding = False # with the 'numpy' decoder, only legal sequences of the tagging scheme (the graph is constrained at training)
 
-updated_lookup_table = update_lookup_table_for_testing(test_sentences, lookup_table, map_id_word, map_word_id, type_embeddings)
+# first pass over the test files only collects the OOV words
+test_sentences = (sent for sent, _, _ in iter_corpus_tsv(test_dirname))
+char_index_matrix = build_char_index_matrix(map_id_word, max_word_len, char_dict)
+updated_lookup_table = update_lookup_table_for_testing(test_sentences, lookup_table, map_id_word, map_word_id, type_embeddings, char_index_matrix, oov_backend=oov_backend, seed=LOOKUP_TABLE_SEED)
 
 config = tf.ConfigProto(allow_soft_placement = True)
 
-with tf.Session(config = config) as sess:
-    saver = tf.train.import_meta_graph('../saved_model/%s-%s/ckpt.meta' % (type_embeddings, tagging))
-    
-    with tf.device("/device:gpu:0"):
-        print(tf.train.latest_checkpoint('../saved_model/%s-%s/' % (type_embeddings, tagging)))
-        saver.restore(sess, tf.train.latest_checkpoint('../saved_model/%s-%s/' % (type_embeddings, tagging)))
-        graph = tf.get_default_graph()
-        chars_placeholder = graph.get_tensor_by_name("characters:0")
-        labels_placeholder = graph.get_tensor_by_name('labels:0')
-        sequence_lengths_placeholder = graph.get_tensor_by_name('lengths:0')
-        dropout_prob_placeholder = graph.get_tensor_by_name('dropout:0')
-        max_sentences_length_in_batch = graph.get_tensor_by_name('max_sentences_length_in_batch:0')
-        vectors = graph.get_tensor_by_name('word-embedding/vectors:0')
-        viterbi_sequence = graph.get_tensor_by_name("crf_decode/cond/Merge:0")
-    
-        tsvfile = open('../testing/predict_test_file_%s_%s.tsv' % (type_embeddings, tagging), 'w')
-
-        feed_dicts = get_feed_dict_for_testting(test_sentences, test_labels, test_sequence_lengths, max_word_len, char_dict, labels_template, updated_lookup_table, map_id_word, map_word_id, type_embeddings, tagging)
-        for idx, fd in enumerate(feed_dicts):
-            # print('\n\n%s\n\n' % ' '.join(test_sentences[idx]))
-            feed_dict = {
-                chars_placeholder: fd['chars_placeholder'],
-                labels_placeholder: fd['labels_placeholder'],
-                sequence_lengths_placeholder: fd['sequence_lengths_placeholder'],
-                dropout_prob_placeholder: fd['dropout_prob_placeholder'],
-                vectors: fd['vectors'],
-                max_sentences_length_in_batch: fd['sequence_lengths_placeholder'][0] 
-            }
-
-            predict = sess.run(viterbi_sequence, feed_dict=feed_dict)
-
-            sent = test_sentences[idx]
-            label = test_labels[idx]
-
-            for subidx in range(test_sequence_lengths[idx]):        
+sess, inputs, outputs = load_tagging_model('../saved_model/%s-%s/' % (type_embeddings, tagging), config)
+if decoder == 'numpy' and 'logits' not in outputs:
+    raise ValueError("decoder 'numpy' needs the logits of the exported inference graph, retrain or use decoder 'graph'")
+
+with sess:
+    if decoder == 'numpy':
+        trans_params = sess.run(outputs['trans_params'])
+        constraints = get_allowed_transitions(labels_template, tagging) if constrained_decoding else None
+    tsvfile = open('../testing/predict_test_file_%s_%s.tsv' % (type_embeddings, tagging), 'w')
+
+    feed_dicts = get_batched_feed_dict_for_testing(iter_corpus_tsv(test_dirname), max_word_len, char_dict, labels_template, updated_lookup_table, map_id_word, map_word_id, \
+                                                    batch_size=predict_batch_size, char_index_matrix=char_index_matrix)
+    for batch, fd in feed_dicts:
+        feed_dict = {tensor: fd[TESTING_FEED_KEYS[name]] for name, tensor in inputs.items()}
+
+        if decoder == 'numpy':
+            logits = sess.run(outputs['logits'], feed_dict=feed_dict)
+            predicts, _ = viterbi_decode(logits, trans_params, fd['sequence_lengths_placeholder'], constraints)
+        else:
+            predicts = sess.run(outputs['viterbi_sequence'], feed_dict=feed_dict)
+
+        for (sent, label, sequence_length), predict in zip(batch, predicts):
+            for subidx in range(sequence_length):
                 word = sent[subidx]
                 golden_tag = label[subidx]
-                predict_tag = labels_template[predict[0][subidx]]
+                predict_tag = labels_template[predict[subidx]]
                 tsvfile.write("%s\t%s\t%s\n" % (word, golden_tag, predict_tag))
             tsvfile.write('-\tX\t-\n')
 
-        tsvfile.close()
-
-
-    
-
-    
-
+    tsvfile.close()